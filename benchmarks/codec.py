@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Encode/decode throughput of the payload codecs by payload size.
+
+    python -m benchmarks.codec
+"""
+import timeit
+
+from lucena.io2 import codec
+
+PAYLOAD_SIZES = (100, 1000, 10000, 100000, 1000000)
+
+
+def build_messages(size):
+    """
+    Two shapes of roughly `size` bytes: one big string and a list of
+    small records.
+    """
+    text = {'$req': 'text', 'body': 'x' * size}
+    records = {
+        '$req': 'records',
+        'items': [
+            {'id': i, 'score': i * 0.5, 'ok': True}
+            for i in range(max(1, size // 40))
+        ]
+    }
+    return [('text', text), ('records', records)]
+
+
+def bench(message_codec, message, number):
+    data = message_codec.encode(message)
+    encode = min(timeit.repeat(
+        lambda: message_codec.encode(message), repeat=3, number=number
+    )) / number
+    decode = min(timeit.repeat(
+        lambda: codec.decode(data), repeat=3, number=number
+    )) / number
+    return len(data), encode, decode
+
+
+def main():
+    print('{:>8} {:>8} {:>8} {:>10} {:>12} {:>12}'.format(
+        'size', 'shape', 'codec', 'bytes', 'enc MB/s', 'dec MB/s'
+    ))
+    codecs = [('json', codec.json_codec), ('binary', codec.binary_codec)]
+    for size in PAYLOAD_SIZES:
+        number = max(3, 200000 // size)
+        for shape, message in build_messages(size):
+            for name, message_codec in codecs:
+                length, encode, decode = bench(message_codec, message, number)
+                print('{:>8} {:>8} {:>8} {:>10} {:>12.1f} {:>12.1f}'.format(
+                    size, shape, name, length,
+                    length / encode / 1e6, length / decode / 1e6
+                ))
+
+
+if __name__ == '__main__':
+    main()
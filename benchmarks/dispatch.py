@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Handler lookup cost as a function of the number of bound handlers.
+
+    python -m benchmarks.dispatch
+"""
+import timeit
+
+from lucena.worker import Worker
+
+
+def build_worker(number_of_handlers):
+    worker = Worker()
+    for i in range(number_of_handlers):
+        if i % 2:
+            worker.bind_handler({'$req': 'get', 'id': i}, lambda m: m)
+        else:
+            worker.bind_handler({'$req': 'op-{}'.format(i)}, lambda m: m)
+    return worker
+
+
+def linear_scan(worker, message):
+    for message_handler in worker.message_handlers:
+        if message_handler.match_in(message):
+            return message_handler.handler
+
+
+def bench_lookup(lookup, number_of_handlers, number=2000):
+    worker = build_worker(number_of_handlers)
+    messages = [
+        {'$req': 'get', 'id': number_of_handlers - 1},
+        {'$req': 'op-0'},
+        {'$req': 'unknown'},
+    ]
+    timer = timeit.Timer(lambda: [lookup(worker, m) for m in messages])
+    seconds = min(timer.repeat(repeat=3, number=number))
+    return seconds / (number * len(messages)) * 1e9
+
+
+def main():
+    print('{:>10} {:>16} {:>16}'.format(
+        'handlers', 'indexed ns/op', 'linear ns/op'
+    ))
+    for number_of_handlers in (10, 100, 1000):
+        print('{:>10} {:>16.0f} {:>16.0f}'.format(
+            number_of_handlers,
+            bench_lookup(Worker.get_handler_for, number_of_handlers),
+            bench_lookup(linear_scan, number_of_handlers)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the per-message hot paths: handler matching and
+lookup, envelope framing and Response construction.
+
+    python -m benchmarks.micro [--output micro.json]
+
+Memory is measured with tracemalloc, which only tracks live blocks: the
+peak bytes allocated over a run of 100 operations (not divided, as
+temporaries are freed between operations), and the bytes and blocks every
+operation leaves allocated, the latter from the difference of the block
+counts of two snapshots taken around the run.
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+
+import zmq
+
+from benchmarks.dispatch import build_worker
+from lucena.io2.socket import DealerSocket, Response, Socket
+from lucena.message_handler import MessageHandler
+
+MESSAGE = {'$req': 'get', 'id': 42, 'fields': ['name', 'email']}
+# Timed runs of every measure and operations of its memory runs.
+REPEAT = 3
+MEMORY_NUMBER = 100
+
+
+def measure(name, operation, number=10000, memory_number=MEMORY_NUMBER):
+    seconds = min(timeit.repeat(operation, repeat=REPEAT, number=number))
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(memory_number):
+            operation()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'name': name,
+        'ns_per_op': seconds / number * 1e9,
+        'peak_bytes': peak - before,
+        'retained_bytes_per_op': (current - before) / memory_number,
+        'allocations_per_op': count_allocations(operation, memory_number),
+    }
+
+
+def count_allocations(operation, number):
+    # A run of its own: the snapshots would inflate the peak above.
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(number):
+            operation()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    blocks = sum(
+        stat.count_diff
+        for stat in after.filter_traces(ignore).compare_to(
+            before.filter_traces(ignore), 'filename'
+        )
+    )
+    return blocks / number
+
+
+def calls_of_measure(number=10000, memory_number=MEMORY_NUMBER):
+    # Timed runs, then the memory run and the allocations run.
+    return REPEAT * number + 2 * memory_number
+
+
+def bench_message_handler():
+    handler = MessageHandler({'$req': 'get', 'id': 42}, None)
+    other = MessageHandler({'$req': 'get', 'fields': 1}, None)
+    yield measure('match_in hit', lambda: handler.match_in(MESSAGE))
+    yield measure('match_in miss', lambda: other.match_in(MESSAGE))
+    yield measure('__lt__', lambda: handler < other)
+    handlers = [
+        MessageHandler({'$req': 'op-{}'.format(i)}, None) for i in range(100)
+    ]
+    yield measure('sort 100 handlers', lambda: sorted(handlers), number=1000)
+    worker = build_worker(99)
+    yield measure(
+        'bind_handler 100th',
+        lambda: (worker.bind_handler({'$req': 'new'}, None),
+                 worker.unbind_handler({'$req': 'new'})),
+        number=200
+    )
+
+
+def bench_get_handler_for():
+    for number_of_handlers in (10, 100, 1000):
+        worker = build_worker(number_of_handlers)
+        message = {'$req': 'get', 'id': number_of_handlers - 1}
+        yield measure(
+            'get_handler_for {} handlers'.format(number_of_handlers),
+            lambda: worker.get_handler_for(message)
+        )
+
+
+def bench_socket():
+    context = zmq.Context.instance()
+    endpoint = Socket.inproc_unique_endpoint()
+    controller = Socket(context, zmq.ROUTER)
+    worker = DealerSocket(context, zmq.DEALER, identity=b'worker')
+    # One-way cases queue every message they send: don't drop any.
+    for socket in (controller, worker):
+        socket.setsockopt(zmq.SNDHWM, 0)
+        socket.setsockopt(zmq.RCVHWM, 0)
+    controller.bind(endpoint)
+    worker.connect(endpoint)
+    worker.send_to_client(b'$controller', b'$uuid', {'$signal': 'ready'})
+    controller.recv_from_worker()
+    headers = {'deadline': 2e9}
+
+    def round_trip():
+        controller.send_to_worker(
+            b'worker', b'client', b'$uuid', MESSAGE, headers
+        )
+        response = worker.recv_from_client()
+        worker.send_to_client(
+            response.client, response.uuid, response.message, headers
+        )
+        controller.recv_from_worker()
+
+    def drain(socket):
+        while socket.poll(100):
+            socket.recv_multipart()
+
+    payload = controller.encode(MESSAGE)
+    try:
+        yield measure('encode', lambda: controller.encode(MESSAGE))
+        yield measure('decode', lambda: Socket.decode(payload))
+        yield measure(
+            'send_to_worker (encode)',
+            lambda: controller.send_to_worker(
+                b'worker', b'client', b'$uuid', MESSAGE, headers
+            )
+        )
+        drain(worker)
+        # Queued ahead: one reply for every call of the measure.
+        for _ in range(calls_of_measure()):
+            worker.send_to_client(b'client', b'$uuid', MESSAGE, headers)
+        yield measure(
+            'recv_from_worker (decode)',
+            controller.recv_from_worker
+        )
+        yield measure('send/recv round trip', round_trip)
+    finally:
+        worker.close()
+        controller.close()
+
+
+def bench_response():
+    yield measure(
+        'Response()',
+        lambda: Response(MESSAGE, b'worker', b'client', b'$uuid', None)
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+    print('{:<28} {:>10} {:>10} {:>12} {:>10}'.format(
+        'operation', 'ns/op', 'peak B', 'retained B', 'allocs/op'
+    ))
+    results = []
+    for bench in (bench_message_handler, bench_get_handler_for,
+                  bench_socket, bench_response):
+        for result in bench():
+            results.append(result)
+            print('{:<28} {:>10.0f} {:>10} {:>12.1f} {:>10.2f}'.format(
+                result['name'],
+                result['ns_per_op'],
+                result['peak_bytes'],
+                result['retained_bytes_per_op'],
+                result['allocations_per_op']
+            ))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
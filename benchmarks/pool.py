@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of a CPU-bound handler with thread and process worker pools.
+
+    python -m benchmarks.pool
+"""
+import tempfile
+import threading
+import time
+
+from lucena.client import RemoteClient
+from lucena.service import create_service
+from lucena.worker import Worker
+
+
+class CPUWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(CPUWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'burn'}, CPUWorker.handler_burn)
+
+    @staticmethod
+    def handler_burn(message):
+        total = 0
+        for i in range(message['n']):
+            total += i * i
+        return {'$rep': total}
+
+
+def run_clients(endpoint, concurrency, requests_per_client, n):
+    def client_task():
+        client = RemoteClient(default_timeout=60000)
+        client.connect(endpoint)
+        for _ in range(requests_per_client):
+            client.resolve({'$req': 'burn', 'n': n})
+        client.close()
+
+    clients = [
+        threading.Thread(target=client_task) for _ in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    return concurrency * requests_per_client / (time.perf_counter() - start)
+
+
+def bench(worker_mode, number_of_workers, n=200000, requests_per_client=4):
+    endpoint = "ipc://{}.ipc".format(tempfile.NamedTemporaryFile().name)
+    service = create_service(
+        'CPUService',
+        worker_factory=CPUWorker,
+        number_of_workers=number_of_workers,
+        endpoint=endpoint,
+        worker_mode=worker_mode
+    )
+    service.start()
+    try:
+        return run_clients(
+            endpoint, number_of_workers, requests_per_client, n
+        )
+    finally:
+        service.stop()
+
+
+def main():
+    print('{:>8} {:>8} {:>12}'.format('mode', 'workers', 'req/s'))
+    for worker_mode in ('thread', 'process'):
+        for number_of_workers in (1, 2, 4, 8):
+            print('{:>8} {:>8} {:>12.1f}'.format(
+                worker_mode,
+                number_of_workers,
+                bench(worker_mode, number_of_workers)
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput and latency of RemoteClient -> Service -> Worker by
+number of workers, transport, payload size and client concurrency. Every
+run is saved as JSON to compare commits:
+
+    python -m benchmarks.service --output before.json
+    python -m benchmarks.service --output after.json
+    python -m benchmarks.service --compare before.json after.json
+
+Everything runs on the local host: tcp uses the loopback interface.
+"""
+import argparse
+import json
+import platform
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import zmq
+
+from lucena.client import RemoteClient
+from lucena.io2.socket import Socket
+from lucena.service import create_service
+from lucena.worker import Worker
+
+TRANSPORTS = ('inproc', 'ipc', 'tcp')
+NUMBER_OF_WORKERS = (1, 2, 4, 8)
+PAYLOAD_SIZES = (100, 10000, 100000, 1000000)
+CONCURRENCY = (1, 4, 16)
+
+
+class EchoWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(EchoWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'echo'}, EchoWorker.handler_echo)
+
+    @staticmethod
+    def handler_echo(message):
+        return {'$rep': message['data']}
+
+
+def create_endpoint(transport):
+    if transport == 'inproc':
+        return Socket.inproc_unique_endpoint()
+    if transport == 'ipc':
+        return "ipc://{}.ipc".format(tempfile.NamedTemporaryFile().name)
+    # Let the OS pick a free loopback port.
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'tcp://127.0.0.1:{}'.format(s.getsockname()[1])
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(q / 100.0 * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_clients(endpoint, payload_size, concurrency, duration):
+    message = {'$req': 'echo', 'data': 'x' * payload_size}
+    latencies = [[] for _ in range(concurrency)]
+    start_barrier = threading.Barrier(concurrency + 1)
+
+    def client_task(samples):
+        client = RemoteClient(default_timeout=60000)
+        client.connect(endpoint)
+        client.resolve(message)
+        start_barrier.wait()
+        deadline = time.perf_counter() + duration
+        while True:
+            start = time.perf_counter()
+            client.resolve(message)
+            end = time.perf_counter()
+            samples.append(end - start)
+            if end >= deadline:
+                break
+        client.close()
+
+    clients = [
+        threading.Thread(target=client_task, args=(samples,))
+        for samples in latencies
+    ]
+    for client in clients:
+        client.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    samples = sorted(sample for client in latencies for sample in client)
+    return {
+        'requests': len(samples),
+        'requests_per_second': len(samples) / elapsed,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'p999_ms': percentile(samples, 99.9) * 1000,
+    }
+
+
+def bench(transport, number_of_workers, payload_sizes, concurrency_levels,
+          duration, prefetch=1):
+    endpoint = create_endpoint(transport)
+    service = create_service(
+        'EchoService',
+        worker_factory=EchoWorker,
+        number_of_workers=number_of_workers,
+        endpoint=endpoint,
+        prefetch=prefetch
+    )
+    service.start()
+    try:
+        for payload_size in payload_sizes:
+            for concurrency in concurrency_levels:
+                result = {
+                    'transport': transport,
+                    'workers': number_of_workers,
+                    'payload_size': payload_size,
+                    'concurrency': concurrency,
+                    'prefetch': prefetch,
+                }
+                result.update(run_clients(
+                    endpoint, payload_size, concurrency, duration
+                ))
+                yield result
+    finally:
+        service.stop()
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'zmq': zmq.zmq_version(),
+        'pyzmq': zmq.pyzmq_version(),
+    }
+
+
+def result_key(result):
+    return (
+        result['transport'],
+        result['workers'],
+        result['payload_size'],
+        result['concurrency'],
+        # Runs saved before the prefetch option used one credit.
+        result.get('prefetch', 1)
+    )
+
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = {result_key(r): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print('{:>9} {:>8} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+        'transport', 'workers', 'size', 'clients', 'prefetch', 'req/s', 'p99'
+    ))
+    for result in new:
+        old = base.get(result_key(result))
+        if old is None:
+            continue
+        print('{:>9} {:>8} {:>8} {:>8} {:>8} {:>+9.1f}% {:>+9.1f}%'.format(
+            *result_key(result),
+            (result['requests_per_second'] /
+             old['requests_per_second'] - 1) * 100,
+            (result['p99_ms'] / old['p99_ms'] - 1) * 100
+        ))
+
+
+def int_list(value):
+    return tuple(int(item) for item in value.split(','))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--transports', default=','.join(TRANSPORTS))
+    parser.add_argument('--workers', type=int_list, default=NUMBER_OF_WORKERS)
+    parser.add_argument('--sizes', type=int_list, default=PAYLOAD_SIZES)
+    parser.add_argument('--concurrency', type=int_list, default=CONCURRENCY)
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='credits per worker')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds per configuration')
+    parser.add_argument('--output', default='benchmark-service.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = []
+    print('{:>9} {:>8} {:>8} {:>8} {:>8} {:>10} {:>8} {:>8} {:>8}'.format(
+        'transport', 'workers', 'size', 'clients', 'prefetch', 'req/s',
+        'p50 ms', 'p99 ms', 'p999 ms'
+    ))
+    for transport in args.transports.split(','):
+        for number_of_workers in args.workers:
+            for result in bench(transport, number_of_workers, args.sizes,
+                                args.concurrency, args.duration,
+                                args.prefetch):
+                results.append(result)
+                print('{:>9} {:>8} {:>8} {:>8} {:>8} {:>10.1f} {:>8.3f} '
+                      '{:>8.3f} {:>8.3f}'.format(
+                          *result_key(result),
+                          result['requests_per_second'],
+                          result['p50_ms'],
+                          result['p99_ms'],
+                          result['p999_ms']
+                      ))
+    with open(args.output, 'w') as f:
+        json.dump(
+            {'environment': environment(), 'results': results},
+            f,
+            indent=2
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Worker pool startup and shutdown time with a slow worker initialization.
+The serial column starts the same pool one worker at a time, waiting for
+every worker to be ready before starting the next one.
+
+    python -m benchmarks.startup
+"""
+import time
+
+from lucena.worker import Worker
+
+
+class WarmupWorker(Worker):
+    # Stands in for loading a model or warming a cache.
+    warmup = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super(WarmupWorker, self).__init__(*args, **kwargs)
+        time.sleep(self.warmup)
+
+
+def bench_serial(number_of_workers):
+    controller = Worker.Controller(worker_factory=WarmupWorker)
+    start = time.perf_counter()
+    controller.start(number_of_workers=1)
+    for _ in range(number_of_workers - 1):
+        controller.add_worker(wait=True)
+    started = time.perf_counter()
+    controller.stop()
+    return started - start
+
+
+def bench(number_of_workers):
+    controller = Worker.Controller(worker_factory=WarmupWorker)
+    start = time.perf_counter()
+    controller.start(number_of_workers=number_of_workers)
+    started = time.perf_counter()
+    controller.stop()
+    return started - start, time.perf_counter() - started
+
+
+def main():
+    print('{:>8} {:>12} {:>12} {:>12}'.format(
+        'workers', 'serial (s)', 'start (s)', 'stop (s)'
+    ))
+    for number_of_workers in (1, 4, 16, 64):
+        print('{:>8} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+            number_of_workers,
+            bench_serial(number_of_workers),
+            *bench(number_of_workers)
+        ))
+
+
+if __name__ == '__main__':
+    main()
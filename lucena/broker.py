@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import tempfile
+import time
+
+import zmq
+
+from lucena.io2.socket import Socket, trace_event
+from lucena.service import Service
+from lucena.worker import Worker
+
+
+logger = logging.getLogger(__name__)
+
+
+class Broker(Worker):
+    """
+    Named-service broker in the style of Majordomo.
+
+    Service instances, in any process or host, connect to the backend
+    endpoint (Service(broker_endpoint=...)) and register under their
+    service_name. Clients send requests to the frontend endpoint with the
+    service name in the 'service' header (RemoteClient.resolve(message,
+    service_name=...)). Every request goes to the registered instance of
+    that name with the fewest requests in flight. Instances unregister
+    when they stop.
+
+    Broker and instances heartbeat each other every heartbeat_interval
+    milliseconds: an instance silent for heartbeat_liveness intervals,
+    e.g. a crashed one, is dropped, and instances register again when
+    the broker goes silent, e.g. after a restart.
+    """
+
+    # Control messages of the Service instances are sent by this client.
+    BROKER_CLIENT = b'$broker'
+
+    UNKNOWN_SERVICE_REPLY = {'$rep': None, '$error': 'Unknown service'}
+
+    class Controller(Service.Controller):
+
+        def _create_service(self):
+            return Broker(**self.kwargs)
+
+    def __init__(self, endpoint=None, backend_endpoint=None,
+                 default_timeout=None, codec=None, heartbeat_interval=1000,
+                 heartbeat_liveness=3):
+        super(Broker, self).__init__(
+            default_timeout=default_timeout,
+            codec=codec
+        )
+        # The Worker heartbeat timer runs _heartbeat, which heartbeats the
+        # instances.
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_liveness = heartbeat_liveness
+        if endpoint is None:
+            endpoint = "ipc://{}.ipc".format(
+                tempfile.NamedTemporaryFile().name
+            )
+        if backend_endpoint is None:
+            backend_endpoint = "ipc://{}.ipc".format(
+                tempfile.NamedTemporaryFile().name
+            )
+        self.endpoint = endpoint
+        self.backend_endpoint = backend_endpoint
+        self.socket = None
+        self.backend_socket = None
+        # Registered instance identities by service name and the number of
+        # requests in flight by instance identity.
+        self.services = None
+        self.outstanding_requests = None
+        self.last_heartbeats = None
+        self.total_client_requests = 0
+        self.total_unknown_service_replies = 0
+
+    def _before_start(self):
+        super(Broker, self)._before_start()
+        self.services = collections.defaultdict(list)
+        self.outstanding_requests = {}
+        self.last_heartbeats = {}
+        self.socket = Socket(self.context, zmq.ROUTER, codec=self.codec)
+        self.socket.bind(self.endpoint)
+        self.backend_socket = Socket(
+            self.context,
+            zmq.ROUTER,
+            codec=self.codec
+        )
+        self.backend_socket.bind(self.backend_endpoint)
+        self._add_poll_handler(self.socket, zmq.POLLIN, self._handle_socket)
+        self._add_poll_handler(
+            self.backend_socket,
+            zmq.POLLIN,
+            self._handle_backend_socket
+        )
+
+    def _before_stop(self):
+        super(Broker, self)._before_stop()
+        self.socket.close()
+        self.backend_socket.close()
+
+    def _handle_socket(self):
+        response = self.socket.recv_batch_from_client(decode=False)
+        trace_event(response.headers, 'broker_receive')
+        self.total_client_requests += len(response.message)
+        service_name = (response.headers or {}).get('service')
+        instances = None
+        if isinstance(service_name, str):
+            instances = self.services.get(service_name)
+        if not instances:
+            self.total_unknown_service_replies += 1
+            self.socket.send_batch_to_client(
+                response.client,
+                response.uuid,
+                [self.UNKNOWN_SERVICE_REPLY] * len(response.message),
+                response.headers
+            )
+            return
+        # Fewest requests in flight; moving the chosen instance to the end
+        # turns ties into round robin.
+        identity = min(instances, key=self.outstanding_requests.get)
+        instances.remove(identity)
+        instances.append(identity)
+        self.outstanding_requests[identity] += 1
+        self.backend_socket.send_batch_to_worker(
+            identity,
+            response.client,
+            response.uuid,
+            response.message,
+            response.headers
+        )
+
+    def _handle_backend_socket(self):
+        response = self.backend_socket.recv_batch_from_worker(decode=False)
+        if response.worker in self.last_heartbeats:
+            self.last_heartbeats[response.worker] = time.monotonic()
+        if response.client == self.BROKER_CLIENT:
+            self._handle_instance_signal(
+                response.worker,
+                Socket.decode(response.message[0])
+            )
+            return
+        if response.worker in self.outstanding_requests:
+            self.outstanding_requests[response.worker] -= 1
+        self.socket.send_batch_to_client(
+            response.client,
+            response.uuid,
+            response.message,
+            response.headers
+        )
+
+    def _handle_instance_signal(self, identity, message):
+        signal = message.get('$signal')
+        if signal == 'register' and identity not in self.outstanding_requests:
+            self.services[message['service']].append(identity)
+            self.outstanding_requests[identity] = 0
+            self.last_heartbeats[identity] = time.monotonic()
+        elif signal == 'unregister' and identity in self.outstanding_requests:
+            self._unregister(identity)
+
+    def _unregister(self, identity):
+        del self.outstanding_requests[identity]
+        del self.last_heartbeats[identity]
+        for instances in self.services.values():
+            if identity in instances:
+                instances.remove(identity)
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        expiry = self.heartbeat_interval * self.heartbeat_liveness / 1000.0
+        for identity, last_heartbeat in list(self.last_heartbeats.items()):
+            if now - last_heartbeat > expiry:
+                logger.warning(
+                    "Instance %s missed its heartbeats: dropping it",
+                    identity.decode('utf8')
+                )
+                self._unregister(identity)
+            else:
+                self.backend_socket.send_to_worker(
+                    identity,
+                    self.BROKER_CLIENT,
+                    b'$uuid',
+                    self.HEARTBEAT
+                )
+
+    @property
+    def registered_services(self):
+        return {
+            service_name: len(instances)
+            for service_name, instances in self.services.items()
+            if instances
+        }
+
+
+def create_broker(endpoint=None, backend_endpoint=None, codec=None,
+                  heartbeat_interval=1000, heartbeat_liveness=3):
+    return Broker.Controller(
+        endpoint=endpoint,
+        backend_endpoint=backend_endpoint,
+        codec=codec,
+        heartbeat_interval=heartbeat_interval,
+        heartbeat_liveness=heartbeat_liveness
+    )
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import time
+
+from lucena.message_handler import MessageHandler, MessageHandlerIndex, \
+    pattern_index
+
+
+class ResponseCache(object):
+    """
+    LRU cache of encoded replies for idempotent handlers.
+
+    Only messages matching a cacheable pattern (with the precedence rules
+    of MessageHandler) are cached, keyed by the same canonical JSON used by
+    MessageHandler.key. Every pattern has its own TTL in milliseconds; None
+    never expires. The least recently used replies are evicted to keep at
+    most max_entries replies and max_bytes of keys plus payloads.
+    """
+
+    CacheKey = collections.namedtuple('CacheKey', ['key', 'ttl'])
+    Entry = collections.namedtuple('Entry', ['payload', 'size', 'expires'])
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        if not isinstance(max_entries, int) or max_entries < 1:
+            raise ValueError(
+                "Parameter max_entries must be a positive integer."
+            )
+        if not isinstance(max_bytes, int) or max_bytes < 1:
+            raise ValueError("Parameter max_bytes must be a positive integer.")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.patterns = []
+        self.pattern_index = MessageHandlerIndex()
+        # TTL by pattern, keyed by MessageHandler.key.
+        self.ttls = {}
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def add_pattern(self, message, ttl=None):
+        key = MessageHandler(message, None).key
+        if key not in self.ttls:
+            self.patterns.append(message)
+            self.pattern_index = pattern_index(self.patterns)
+        self.ttls[key] = ttl
+
+    def key_for(self, message):
+        """
+        Return the CacheKey of a message, or None if it isn't cacheable.
+        """
+        if not isinstance(message, dict):
+            return None
+        pattern = self.pattern_index.lookup(message)
+        if pattern is None:
+            return None
+        try:
+            key = json.dumps(message, sort_keys=True)
+        except TypeError:
+            # Values the JSON codec can't represent, e.g. bytes.
+            return None
+        return self.CacheKey(key, self.ttls[pattern.key])
+
+    def get(self, cache_key):
+        entry = self.entries.get(cache_key.key)
+        if entry is not None and entry.expires is not None and \
+                entry.expires <= time.monotonic():
+            self._remove(cache_key.key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(cache_key.key)
+        self.hits += 1
+        return entry.payload
+
+    def put(self, cache_key, payload):
+        size = len(cache_key.key) + len(payload)
+        if size > self.max_bytes:
+            return
+        if cache_key.key in self.entries:
+            self._remove(cache_key.key)
+        expires = None
+        if cache_key.ttl is not None:
+            expires = time.monotonic() + cache_key.ttl / 1000.0
+        self.entries[cache_key.key] = self.Entry(payload, size, expires)
+        self.size += size
+        while len(self.entries) > self.max_entries or \
+                self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
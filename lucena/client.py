@@ -1,30 +1,675 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import math
+import threading
+import time
+import uuid
+
 import zmq
+import zmq.asyncio
 
 from lucena.exceptions import IOTimeout
-from lucena.io2.socket import Socket
+from lucena.io2 import codec as payload_codec
+from lucena.io2.socket import DealerSocket, Socket
+from lucena.message_handler import pattern_index
+
+
+def request_headers(service_name=None, timeout=None, tracer=None):
+    """
+    Headers of a request, None when there are none to send.
+    """
+    headers = {}
+    # Read by a lucena.broker.Broker to route the request.
+    if service_name is not None:
+        headers['service'] = service_name
+    # The deadline lets the Service and its workers skip requests the
+    # client no longer waits for.
+    if timeout is not None:
+        headers['deadline'] = time.time() + timeout / 1000.0
+    if tracer is not None:
+        trace = tracer.start()
+        if trace is not None:
+            headers['trace'] = trace
+    return headers or None
 
 
 class RemoteClient(object):
 
-    def __init__(self, default_timeout=None):
+    def __init__(self, default_timeout=None, codec=None, tracer=None):
         self.default_timeout = default_timeout
-        self.socket = Socket(zmq.Context.instance(), zmq.REQ)
-        self.socket.setsockopt(zmq.LINGER, 0)
-        if default_timeout is not None:
+        self.codec = codec
+        # Optional lucena.tracing.Tracer sampling the requests to trace.
+        self.tracer = tracer
+        self.endpoints = []
+        self.socket = self._create_socket()
+
+    def _create_socket(self):
+        socket = Socket(zmq.Context.instance(), zmq.REQ, codec=self.codec)
+        socket.setsockopt(zmq.LINGER, 0)
+        if self.default_timeout is not None:
             # TODO: Replace with Poll object.
-            self.socket.setsockopt(zmq.RCVTIMEO, default_timeout)
+            socket.setsockopt(zmq.RCVTIMEO, self.default_timeout)
+        return socket
 
     def connect(self, endpoint):
         self.socket.connect(endpoint)
+        self.endpoints.append(endpoint)
 
-    def resolve(self, message):
-        self.socket.send_to_service(b'$uuid', message)
+    def reset(self):
+        """
+        A REQ socket that timed out waiting for a reply can't send again.
+        Replace it with a fresh socket connected to the same endpoints.
+        """
+        self.socket.close()
+        self.socket = self._create_socket()
+        for endpoint in self.endpoints:
+            self.socket.connect(endpoint)
+
+    def _headers(self, service_name=None):
+        return request_headers(service_name, self.default_timeout, self.tracer)
+
+    def _finish_trace(self, response):
+        if self.tracer is not None and response.headers and \
+                'trace' in response.headers:
+            self.tracer.finish(response.headers['trace'])
+
+    def resolve(self, message, service_name=None):
+        self.socket.send_to_service(
+            b'$uuid',
+            message,
+            self._headers(service_name)
+        )
         try:
             response = self.socket.recv_from_service()
-            return response.message
         except zmq.error.Again:
             raise IOTimeout()
+        self._finish_trace(response)
+        return response.message
+
+    def resolve_many(self, messages, service_name=None):
+        """
+        Resolve a list of messages in a single round trip. The Service
+        fans them out across its workers and replies in the same order.
+        """
+        if not messages:
+            return []
+        self.socket.send_batch_to_service(
+            b'$uuid',
+            messages,
+            self._headers(service_name)
+        )
+        try:
+            response = self.socket.recv_batch_from_service()
+        except zmq.error.Again:
+            raise IOTimeout()
+        self._finish_trace(response)
+        return response.message
+
+    def close(self):
+        self.socket.close()
+
+
+class ResilientClient(object):
+    """
+    Client of one or more endpoints of a service that recovers from slow
+    and lost replies. Every endpoint gets its own DEALER socket and every
+    request its own uuid, so a late reply is recognised and dropped.
+
+    Requests are sent round robin across the endpoints. A request not
+    answered within the timeout raises IOTimeout. The socket it was sent
+    on is replaced by a fresh one, as in the Lazy Pirate pattern, so the
+    client stays usable.
+
+    Only messages matching idempotent_patterns are retried or hedged
+    ({} matches every message):
+
+    - retries: after a timeout the request is sent again, on the next
+      endpoint, up to `retries` times. The wait between attempts starts at
+      `backoff` milliseconds and doubles after every attempt.
+    - hedge: a request still unanswered after the hedge delay is sent
+      again to the next endpoint. The first reply wins. The hedge delay is
+      the hedge_percentile of the recent latencies. hedge_delay
+      (milliseconds) is used until enough latencies are known.
+    """
+
+    # Recent latencies used for the hedge delay and the minimum needed.
+    HEDGE_WINDOW = 100
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, default_timeout=None, codec=None, tracer=None,
+                 idempotent_patterns=None, retries=3, backoff=100,
+                 hedge=False, hedge_delay=None, hedge_percentile=95):
+        self.default_timeout = default_timeout
+        self.codec = codec
+        self.tracer = tracer
+        self.idempotent_index = None
+        if idempotent_patterns:
+            self.idempotent_index = pattern_index(idempotent_patterns)
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.latencies = collections.deque(maxlen=self.HEDGE_WINDOW)
+        self.endpoints = []
+        self.sockets = []
+        self.poller = zmq.Poller()
+        self.next_endpoint = 0
+        self.total_requests = 0
+        self.total_timeouts = 0
+        self.total_retries = 0
+        self.total_hedges = 0
+        self.total_hedge_wins = 0
+        self.total_late_replies = 0
+
+    def _create_socket(self, endpoint):
+        socket = DealerSocket(
+            zmq.Context.instance(),
+            zmq.DEALER,
+            codec=self.codec
+        )
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoint)
+        self.poller.register(socket, zmq.POLLIN)
+        return socket
+
+    def connect(self, endpoint):
+        self.endpoints.append(endpoint)
+        self.sockets.append(self._create_socket(endpoint))
+
+    def reset(self, index=None):
+        """
+        Replace the socket of an endpoint, or of all of them, with a fresh
+        one: replies still queued in the old socket are discarded.
+        """
+        indexes = range(len(self.sockets)) if index is None else [index]
+        for index in indexes:
+            self.poller.unregister(self.sockets[index])
+            self.sockets[index].close()
+            self.sockets[index] = self._create_socket(self.endpoints[index])
+
+    def _is_idempotent(self, message):
+        return self.idempotent_index is not None and \
+            isinstance(message, dict) and \
+            self.idempotent_index.lookup(message) is not None
+
+    def current_hedge_delay(self):
+        """
+        Milliseconds to wait before hedging, None when unknown yet.
+        """
+        if len(self.latencies) < self.HEDGE_MIN_SAMPLES:
+            return self.hedge_delay
+        latencies = sorted(self.latencies)
+        index = min(
+            len(latencies) - 1,
+            int(self.hedge_percentile / 100.0 * len(latencies))
+        )
+        return latencies[index] * 1000
+
+    def _headers(self, service_name=None):
+        return request_headers(service_name, self.default_timeout, self.tracer)
+
+    def resolve(self, message, service_name=None):
+        if not self.endpoints:
+            raise ValueError("Client not connected.")
+        self.total_requests += 1
+        idempotent = self._is_idempotent(message)
+        retries = self.retries if idempotent else 0
+        backoff = self.backoff
+        for attempt in range(retries + 1):
+            if attempt:
+                self.total_retries += 1
+                time.sleep(backoff / 1000.0)
+                backoff *= 2
+            try:
+                return self._attempt(
+                    message,
+                    service_name,
+                    hedge=self.hedge and idempotent
+                )
+            except IOTimeout:
+                self.total_timeouts += 1
+                if attempt == retries:
+                    raise
+
+    def _attempt(self, message, service_name, hedge):
+        request_uuid = uuid.uuid4().hex.encode('utf-8')
+        headers = self._headers(service_name)
+        start = time.monotonic()
+        deadline = None
+        if self.default_timeout is not None:
+            deadline = start + self.default_timeout / 1000.0
+        hedge_at = None
+        if hedge and len(self.endpoints) > 1:
+            hedge_delay = self.current_hedge_delay()
+            if hedge_delay is not None:
+                hedge_at = start + hedge_delay / 1000.0
+        sent = [self._send(request_uuid, message, headers)]
+        while True:
+            wake_at = min(
+                (t for t in (deadline, hedge_at) if t is not None),
+                default=None
+            )
+            timeout = None
+            if wake_at is not None:
+                timeout = max(
+                    0,
+                    int(math.ceil((wake_at - time.monotonic()) * 1000))
+                )
+            for socket, _ in self.poller.poll(timeout):
+                response = socket.recv_from_service()
+                if response.uuid != request_uuid:
+                    # Reply of an earlier attempt or of the losing hedge.
+                    self.total_late_replies += 1
+                    continue
+                self.latencies.append(time.monotonic() - start)
+                if socket is not self.sockets[sent[0]]:
+                    self.total_hedge_wins += 1
+                if self.tracer is not None and response.headers and \
+                        'trace' in response.headers:
+                    self.tracer.finish(response.headers['trace'])
+                return response.message
+            now = time.monotonic()
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                self.total_hedges += 1
+                sent.append(self._send(request_uuid, message, headers))
+            if deadline is not None and now >= deadline:
+                for index in sent:
+                    self.reset(index)
+                raise IOTimeout()
+
+    def _send(self, request_uuid, message, headers):
+        index = self.next_endpoint
+        self.next_endpoint = (index + 1) % len(self.endpoints)
+        self.sockets[index].send_to_service(request_uuid, message, headers)
+        return index
+
+    def stats(self):
+        return {
+            'requests': self.total_requests,
+            'timeouts': self.total_timeouts,
+            'retries': self.total_retries,
+            'hedges': self.total_hedges,
+            'hedge_wins': self.total_hedge_wins,
+            'late_replies': self.total_late_replies,
+            'hedge_delay': self.current_hedge_delay(),
+        }
+
+    def close(self):
+        for socket in self.sockets:
+            self.poller.unregister(socket)
+            socket.close()
+        self.sockets = []
+
+
+class ClientPool(object):
+    """
+    Thread-safe pool of RemoteClient connections keyed by endpoint.
+
+    A client is used by one thread at a time: checkout() hands it out and
+    checkin() returns it. Clients that failed (a timeout leaves a REQ
+    socket unable to send) are reset instead of discarded. At most
+    max_size clients are created per endpoint; checkout() waits for one
+    to be returned when all of them are in use. Clients checked in after
+    close() are closed.
+    """
+
+    def __init__(self, max_size=8, default_timeout=None, codec=None,
+                 checkout_timeout=None, tracer=None):
+        if not isinstance(max_size, int) or max_size < 1:
+            raise ValueError("Parameter max_size must be a positive integer.")
+        self.max_size = max_size
+        self.default_timeout = default_timeout
+        self.codec = codec
+        self.checkout_timeout = checkout_timeout
+        self.tracer = tracer
+        self.condition = threading.Condition()
+        self.idle_clients = collections.defaultdict(list)
+        self.created_clients = collections.Counter()
+        # Checked out clients of discarded endpoints, closed on checkin.
+        self.discarded_clients = collections.Counter()
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+        self.resets = 0
+        self.wait_time = 0.0
+
+    def checkout(self, endpoint, timeout=None):
+        if timeout is None:
+            timeout = self.checkout_timeout
+        start = time.monotonic()
+        client = None
+        with self.condition:
+            while True:
+                if self.idle_clients[endpoint]:
+                    client = self.idle_clients[endpoint].pop()
+                    self.hits += 1
+                    break
+                if self.created_clients[endpoint] < self.max_size:
+                    self.created_clients[endpoint] += 1
+                    self.misses += 1
+                    break
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout / 1000.0 - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.wait_time += time.monotonic() - start
+                        raise IOTimeout()
+                self.condition.wait(remaining)
+            self.wait_time += time.monotonic() - start
+        if client is None:
+            try:
+                client = RemoteClient(
+                    default_timeout=self.default_timeout,
+                    codec=self.codec,
+                    tracer=self.tracer
+                )
+                client.connect(endpoint)
+            except Exception:
+                with self.condition:
+                    self.created_clients[endpoint] -= 1
+                    self.condition.notify()
+                raise
+        return client
+
+    def checkin(self, client, broken=False):
+        endpoint = client.endpoints[0]
+        with self.condition:
+            if self.closed:
+                client.close()
+                return
+            if self.discarded_clients[endpoint]:
+                self.discarded_clients[endpoint] -= 1
+                self.created_clients[endpoint] -= 1
+                self.condition.notify()
+                client.close()
+                return
+        if broken:
+            client.reset()
+        with self.condition:
+            if broken:
+                self.resets += 1
+            if self.closed:
+                # Closed while the client was reset.
+                client.close()
+                return
+            self.idle_clients[endpoint].append(client)
+            self.condition.notify()
+
+    def discard(self, endpoint):
+        """
+        Close the clients of an endpoint that is no longer used. Clients
+        checked out at the time are closed when they are checked in.
+        """
+        with self.condition:
+            idle_clients = self.idle_clients.pop(endpoint, [])
+            for client in idle_clients:
+                client.close()
+            busy = self.created_clients[endpoint] - len(idle_clients) - \
+                self.discarded_clients[endpoint]
+            self.created_clients[endpoint] -= len(idle_clients)
+            self.discarded_clients[endpoint] += busy
+
+    @contextlib.contextmanager
+    def connection(self, endpoint, timeout=None):
+        client = self.checkout(endpoint, timeout=timeout)
+        broken = False
+        try:
+            yield client
+        except (IOTimeout, zmq.ZMQError):
+            # Only socket failures leave the client unusable; errors of
+            # the caller don't.
+            broken = True
+            raise
+        finally:
+            self.checkin(client, broken=broken)
+
+    def resolve(self, endpoint, message, service_name=None):
+        with self.connection(endpoint) as client:
+            return client.resolve(message, service_name=service_name)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'resets': self.resets,
+                'wait_time': self.wait_time,
+                'clients': sum(self.created_clients.values()),
+                'idle_clients': sum(
+                    len(clients) for clients in self.idle_clients.values()
+                ),
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            for clients in self.idle_clients.values():
+                for client in clients:
+                    client.close()
+            self.idle_clients.clear()
+            self.created_clients.clear()
+            self.discarded_clients.clear()
+
+
+class HashRing(object):
+    """
+    Consistent hash ring. Every node is placed at `replicas` virtual points
+    and a key belongs to the first point clockwise from its hash, so adding
+    or removing one of N nodes moves only about 1/N of the keys. Hashes
+    are md5 based: the same in every process.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.points = []
+        self.point_nodes = {}
+        self.nodes = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for replica in range(self.replicas):
+            point = self.hash('{}#{}'.format(node, replica))
+            # On the rare collision the first node keeps the point.
+            if point not in self.point_nodes:
+                self.point_nodes[point] = node
+                bisect.insort(self.points, point)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        self.points = [
+            point for point in self.points
+            if self.point_nodes[point] != node
+        ]
+        self.point_nodes = {
+            point: self.point_nodes[point] for point in self.points
+        }
+
+    def get(self, key):
+        if not self.points:
+            raise LookupError("Empty hash ring.")
+        index = bisect.bisect(self.points, self.hash(key))
+        return self.point_nodes[self.points[index % len(self.points)]]
+
+
+class ShardedClient(object):
+    """
+    Client of data partitioned across several Service endpoints. The shard
+    key of every message, given by shard_key(message), picks its endpoint
+    on a HashRing. By default the key is the whole message.
+
+    Connections come from a ClientPool, by default one per shard.
+    resolve_many sends a single batch to every shard involved, in
+    parallel, and returns the replies in the order of the messages.
+    """
+
+    def __init__(self, endpoints=(), shard_key=None, replicas=100,
+                 pool=None, default_timeout=None, codec=None, tracer=None):
+        self.shard_key = shard_key if shard_key is not None \
+            else ShardedClient.message_key
+        self.ring = HashRing(endpoints, replicas=replicas)
+        self.pool = pool if pool is not None else ClientPool(
+            max_size=1,
+            default_timeout=default_timeout,
+            codec=codec,
+            tracer=tracer
+        )
+        # Threads are only started on the first multi-shard resolve_many.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix='lucena-shard'
+        )
+
+    @staticmethod
+    def message_key(message):
+        return json.dumps(message, sort_keys=True)
+
+    def add_endpoint(self, endpoint):
+        self.ring.add(endpoint)
+
+    def remove_endpoint(self, endpoint):
+        self.ring.remove(endpoint)
+        self.pool.discard(endpoint)
+
+    def endpoint_for(self, message):
+        return self.ring.get(self.shard_key(message))
+
+    def resolve(self, message, service_name=None):
+        return self.pool.resolve(
+            self.endpoint_for(message),
+            message,
+            service_name=service_name
+        )
+
+    def resolve_many(self, messages, service_name=None):
+        shards = collections.OrderedDict()
+        for index, message in enumerate(messages):
+            shards.setdefault(self.endpoint_for(message), []).append(index)
+
+        def resolve_shard(endpoint, indexes):
+            with self.pool.connection(endpoint) as client:
+                return client.resolve_many(
+                    [messages[index] for index in indexes],
+                    service_name=service_name
+                )
+
+        if len(shards) <= 1:
+            results = [
+                resolve_shard(endpoint, indexes)
+                for endpoint, indexes in shards.items()
+            ]
+        else:
+            futures = [
+                self.executor.submit(resolve_shard, endpoint, indexes)
+                for endpoint, indexes in shards.items()
+            ]
+            results = [future.result() for future in futures]
+        replies = [None] * len(messages)
+        for indexes, shard_replies in zip(shards.values(), results):
+            for index, reply in zip(indexes, shard_replies):
+                replies[index] = reply
+        return replies
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+
+
+class AsyncRemoteClient(object):
+    """
+    asyncio client multiplexing many requests over one DEALER socket.
+
+    Every request carries its own uuid and replies are matched to the
+    awaiting futures by uuid, so a single connection can have any number
+    of requests in flight. Timeouts (milliseconds, as in RemoteClient) are
+    handled by the event loop; late replies are dropped.
+    """
+
+    def __init__(self, default_timeout=None, codec=None):
+        self.default_timeout = default_timeout
+        # Shadow the process context so inproc endpoints keep working.
+        self.context = zmq.asyncio.Context.shadow(
+            zmq.Context.instance().underlying
+        )
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.codec = codec if codec is not None else payload_codec.json_codec
+        self.pending_requests = {}
+        self.receiver = None
+
+    def connect(self, endpoint):
+        self.socket.connect(endpoint)
+
+    async def resolve(self, message, timeout=None, service_name=None):
+        if self.receiver is None:
+            self.receiver = asyncio.ensure_future(self._receive())
+        request_uuid = uuid.uuid4().hex.encode('utf-8')
+        future = asyncio.get_event_loop().create_future()
+        self.pending_requests[request_uuid] = future
+        if timeout is None:
+            timeout = self.default_timeout
+        try:
+            headers = request_headers(service_name, timeout)
+            # A DEALER adds no delimiter: mimic the one a REQ socket sends.
+            await self.socket.send_multipart(
+                [Socket.DELIMITER_FRAME] + Socket.envelope(
+                    [],
+                    request_uuid,
+                    [self.codec.encode(message)],
+                    headers
+                )
+            )
+            return await asyncio.wait_for(
+                future,
+                timeout / 1000.0 if timeout is not None else None
+            )
+        except asyncio.TimeoutError:
+            raise IOTimeout()
+        finally:
+            self.pending_requests.pop(request_uuid, None)
+
+    async def _receive(self):
+        try:
+            while True:
+                frames = await self.socket.recv_multipart()
+                assert frames[0] == Socket.DELIMITER_FRAME
+                _, request_uuid, _, payloads = Socket.open_envelope(
+                    frames[1:],
+                    0
+                )
+                future = self.pending_requests.get(request_uuid)
+                if future is not None and not future.done():
+                    future.set_result(payloads[0])
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            # Fail the requests in flight instead of letting them time out;
+            # the next request starts a new receive task.
+            self.receiver = None
+            for future in self.pending_requests.values():
+                if not future.done():
+                    future.set_exception(exc)
 
     def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+            self.receiver = None
         self.socket.close()
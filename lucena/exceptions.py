@@ -25,6 +25,11 @@ class WorkerNotStarted(LucenaException):
     pass
 
 
+class WorkerStartupTimeout(LucenaException):
+    """Timeout waiting for the workers to start."""
+    pass
+
+
 class ServiceAlreadyStarted(LucenaException):
     """This Service has already been started."""
     pass
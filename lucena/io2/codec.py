@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Payload codecs used by lucena.io2.socket.Socket.
+
+A codec turns a message (the JSON data model: dicts, lists, strings,
+numbers, booleans and None) into the bytes of the payload frame and back.
+Every socket encodes with its own codec, but decoding is driven by the
+payload itself: binary payloads start with BinaryCodec.MAGIC, a byte that
+can't start a UTF-8 JSON document, so peers using different codecs can
+talk to each other and replies can be read whatever codec produced them.
+Workers reply with the codec of the request, so a reply carries whatever
+values the client's codec supports, e.g. bytes.
+"""
+import json
+import struct
+
+
+class Codec(object):
+
+    def encode(self, message):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+
+    def encode(self, message):
+        return json.dumps(message).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class BinaryCodec(Codec):
+    """
+    Compact tagged encoding. Every value is a one byte tag followed by a
+    fixed size struct (numbers) or a length prefix and the data (strings,
+    bytes, lists and dicts). Small integers and short strings use the
+    narrow variants. Unlike JSON it carries bytes natively and keeps
+    integers and floats apart.
+    """
+    MAGIC = b'\xb1'
+
+    NONE = ord('N')
+    TRUE = ord('T')
+    FALSE = ord('F')
+    INT32 = ord('i')
+    INT64 = ord('q')
+    BIGINT = ord('n')
+    FLOAT = ord('d')
+    STR8 = ord('s')
+    STR = ord('S')
+    BYTES = ord('b')
+    LIST = ord('l')
+    DICT = ord('m')
+
+    INT32_STRUCT = struct.Struct('<Bi')
+    INT64_STRUCT = struct.Struct('<Bq')
+    FLOAT_STRUCT = struct.Struct('<Bd')
+    SIZE8_STRUCT = struct.Struct('<BB')
+    SIZE_STRUCT = struct.Struct('<BI')
+
+    def encode(self, message):
+        parts = [self.MAGIC]
+        self._encode(message, parts)
+        return b''.join(parts)
+
+    def _encode(self, value, parts):
+        if value is None:
+            parts.append(b'N')
+        elif value is True:
+            parts.append(b'T')
+        elif value is False:
+            parts.append(b'F')
+        elif isinstance(value, str):
+            data = value.encode('utf-8')
+            if len(data) < 0x100:
+                parts.append(self.SIZE8_STRUCT.pack(self.STR8, len(data)))
+            else:
+                parts.append(self.SIZE_STRUCT.pack(self.STR, len(data)))
+            parts.append(data)
+        elif isinstance(value, int):
+            if -0x80000000 <= value <= 0x7fffffff:
+                parts.append(self.INT32_STRUCT.pack(self.INT32, value))
+            elif -0x8000000000000000 <= value <= 0x7fffffffffffffff:
+                parts.append(self.INT64_STRUCT.pack(self.INT64, value))
+            else:
+                data = str(value).encode()
+                parts.append(self.SIZE_STRUCT.pack(self.BIGINT, len(data)))
+                parts.append(data)
+        elif isinstance(value, float):
+            parts.append(self.FLOAT_STRUCT.pack(self.FLOAT, value))
+        elif isinstance(value, dict):
+            parts.append(self.SIZE_STRUCT.pack(self.DICT, len(value)))
+            for key, item in value.items():
+                self._encode(key, parts)
+                self._encode(item, parts)
+        elif isinstance(value, (list, tuple)):
+            parts.append(self.SIZE_STRUCT.pack(self.LIST, len(value)))
+            for item in value:
+                self._encode(item, parts)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            data = bytes(value)
+            parts.append(self.SIZE_STRUCT.pack(self.BYTES, len(data)))
+            parts.append(data)
+        else:
+            raise TypeError(
+                "Object of type {} is not serializable".format(
+                    value.__class__.__name__
+                )
+            )
+
+    def decode(self, data):
+        data = bytes(data)
+        if data[:1] != self.MAGIC:
+            raise ValueError("Not a binary payload.")
+        try:
+            value, offset = self._decode(data, 1)
+        except (IndexError, KeyError, TypeError, RecursionError,
+                struct.error):
+            # TypeError: an unhashable dict key, e.g. a decoded list.
+            raise ValueError("Malformed binary payload.")
+        if offset != len(data):
+            raise ValueError("Malformed binary payload.")
+        return value
+
+    def _decode(self, data, offset):
+        tag = data[offset]
+        if tag == self.STR8:
+            end = offset + 2 + data[offset + 1]
+            if end > len(data):
+                raise IndexError()
+            return data[offset + 2:end].decode('utf-8'), end
+        if tag == self.INT32:
+            return self.INT32_STRUCT.unpack_from(data, offset)[1], offset + 5
+        if tag == self.DICT:
+            size = self.SIZE_STRUCT.unpack_from(data, offset)[1]
+            offset += 5
+            items = {}
+            for _ in range(size):
+                key, offset = self._decode(data, offset)
+                items[key], offset = self._decode(data, offset)
+            return items, offset
+        if tag == self.LIST:
+            size = self.SIZE_STRUCT.unpack_from(data, offset)[1]
+            offset += 5
+            items = []
+            for _ in range(size):
+                item, offset = self._decode(data, offset)
+                items.append(item)
+            return items, offset
+        if tag == self.FLOAT:
+            return self.FLOAT_STRUCT.unpack_from(data, offset)[1], offset + 9
+        if tag == self.TRUE:
+            return True, offset + 1
+        if tag == self.FALSE:
+            return False, offset + 1
+        if tag == self.NONE:
+            return None, offset + 1
+        if tag == self.INT64:
+            return self.INT64_STRUCT.unpack_from(data, offset)[1], offset + 9
+        if tag in (self.STR, self.BYTES, self.BIGINT):
+            size = self.SIZE_STRUCT.unpack_from(data, offset)[1]
+            start = offset + 5
+            end = start + size
+            if end > len(data):
+                raise IndexError()
+            if tag == self.STR:
+                return data[start:end].decode('utf-8'), end
+            if tag == self.BIGINT:
+                return int(data[start:end]), end
+            return data[start:end], end
+        raise KeyError(tag)
+
+
+json_codec = JSONCodec()
+binary_codec = BinaryCodec()
+
+
+def codec_of(data):
+    """
+    The codec that produced a payload frame.
+    """
+    if data[:1] == BinaryCodec.MAGIC:
+        return binary_codec
+    return json_codec
+
+
+def decode(data):
+    """
+    Decode a payload frame produced by any of the codecs.
+    """
+    return codec_of(data).decode(data)
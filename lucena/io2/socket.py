@@ -1,17 +1,48 @@
 # -*- coding: utf-8 -*-
 import json
 import struct
+import time
 import uuid
 
 import zmq
 
+from lucena.io2 import codec
+
+
+def deadline_expired(headers, now=None):
+    """
+    True if the headers carry a deadline (seconds since the epoch, set by
+    the client) that has already passed.
+    """
+    if not headers or headers.get('deadline') is None:
+        return False
+    return (now if now is not None else time.time()) > headers['deadline']
+
+
+def trace_event(headers, event, now=None):
+    """
+    Timestamp (seconds since the epoch) a hop of a traced request: the
+    headers of sampled requests carry a 'trace' object filled at each hop.
+    """
+    if not headers:
+        return
+    trace = headers.get('trace')
+    if trace is not None:
+        trace[event] = now if now is not None else time.time()
+
 
 class Response(object):
-    def __init__(self, message, worker=None, client=None, uuid=None):
+    def __init__(self, message, worker=None, client=None, uuid=None,
+                 headers=None):
         self.message = message
         self.worker = worker
         self.client = client
         self.uuid = uuid
+        self.headers = headers
+
+    @property
+    def expired(self):
+        return deadline_expired(self.headers)
 
     # def validate(self, message=None, worker=None, client=None, uuid=None):
     #     if message and not message == self.message:
@@ -29,6 +60,7 @@ class Socket(zmq.Socket):
     DELIMITER_FRAME = b''
     SIGNAL_READY = 0x7f000001
     SIGNAL_STOP = 0x7f000002
+    codec = None
 
     @staticmethod
     def is_signal(message):
@@ -71,9 +103,14 @@ class Socket(zmq.Socket):
         identity = None
         if 'identity' in kwargs:
             identity = kwargs.pop('identity')
+        message_codec = kwargs.pop('codec', None)
         super(Socket, self).__init__(context, sock_type, **kwargs)
         if identity is not None:
             self.identity = identity
+        # Outgoing payloads are encoded with this codec; incoming ones are
+        # decoded with whatever codec produced them.
+        self.codec = message_codec if message_codec is not None \
+            else codec.json_codec
 
     def signal(self, status=0):
         assert status < 0x7fffffff
@@ -85,66 +122,154 @@ class Socket(zmq.Socket):
         assert Socket.is_signal(message)
         return struct.unpack('I', message)[0]
 
-    def send_to_client(self, client, uuid, message):
-        self.send_multipart([
-            client,
-            Socket.DELIMITER_FRAME,
+    def encode(self, message):
+        """
+        Encode a message with the socket codec. Payloads that are already
+        encoded (bytes or zmq.Frame) are forwarded untouched.
+        """
+        if isinstance(message, (bytes, zmq.Frame)):
+            return message
+        return self.codec.encode(message)
+
+    @staticmethod
+    def decode(payload, decode=True):
+        if not decode:
+            return payload
+        if isinstance(payload, zmq.Frame):
+            payload = payload.bytes
+        return codec.decode(payload)
+
+    @staticmethod
+    def envelope(routing, uuid, payloads, headers=None):
+        """
+        Frames of encoded payloads behind an envelope: every routing frame
+        followed by a delimiter, the uuid frame, an optional header frame
+        (a JSON object, i.e. never empty) and the delimiter before the
+        payloads.
+        """
+        frames = []
+        for frame in routing:
+            frames.append(frame)
+            frames.append(Socket.DELIMITER_FRAME)
+        frames.append(uuid)
+        if headers:
+            frames.append(json.dumps(headers).encode('utf-8'))
+        frames.append(Socket.DELIMITER_FRAME)
+        frames.extend(payloads)
+        return frames
+
+    def send_envelope(self, routing, uuid, messages, headers=None):
+        self.send_multipart(Socket.envelope(
+            routing,
             uuid,
-            Socket.DELIMITER_FRAME,
-            bytes(json.dumps(message).encode('utf-8'))
-        ])
-
-    def recv_from_client(self):
-        frames = self.recv_multipart()
-        assert len(frames) == 5
-        assert frames[1] == Socket.DELIMITER_FRAME
-        assert frames[3] == Socket.DELIMITER_FRAME
-        return Response(
-            json.loads(frames[4].decode('utf-8')),
-            client=frames[0],
-            uuid=frames[2]
+            [self.encode(message) for message in messages],
+            headers
+        ))
+
+    def recv_envelope(self, hops, decode=True):
+        """
+        Receive a message sent with send_envelope through `hops` routing
+        frames. Returns the routing frames, the uuid, the headers and the
+        payloads. Unless decoded, payloads are zero-copy zmq.Frame objects
+        so they can be forwarded as is; envelope frames are always bytes.
+        """
+        return Socket.open_envelope(
+            self.recv_multipart(copy=decode),
+            hops,
+            decode
         )
 
-    def send_to_worker(self, worker, client, uuid, message):
-        self.send_multipart([
-            worker,
-            Socket.DELIMITER_FRAME,
-            client,
-            Socket.DELIMITER_FRAME,
-            uuid,
-            Socket.DELIMITER_FRAME,
-            bytes(json.dumps(message).encode('utf-8'))
-        ])
-
-    def recv_from_worker(self):
-        frames = self.recv_multipart()
-        assert len(frames) == 7
-        assert frames[1] == Socket.DELIMITER_FRAME
-        assert frames[3] == Socket.DELIMITER_FRAME
-        assert frames[5] == Socket.DELIMITER_FRAME
+    @staticmethod
+    def open_envelope(frames, hops, decode=True):
+        """
+        Split the frames of an envelope, see recv_envelope.
+        """
+        if not decode:
+            frames = [
+                frame.bytes if i <= 2 * hops + 1 else frame
+                for i, frame in enumerate(frames)
+            ]
+        index = 2 * hops
+        assert len(frames) >= index + 3
+        for i in range(1, index, 2):
+            assert frames[i] == Socket.DELIMITER_FRAME
+        headers = None
+        if frames[index + 1] != Socket.DELIMITER_FRAME:
+            headers = json.loads(frames[index + 1].decode('utf-8'))
+            index += 1
+            if not decode:
+                frames[index + 1] = frames[index + 1].bytes
+        assert frames[index + 1] == Socket.DELIMITER_FRAME
+        payloads = [
+            Socket.decode(frame, decode) for frame in frames[index + 2:]
+        ]
+        assert payloads
+        return frames[0:2 * hops:2], frames[2 * hops], headers, payloads
+
+    def send_to_client(self, client, uuid, message, headers=None):
+        self.send_envelope([client], uuid, [message], headers)
+
+    def recv_from_client(self, decode=True):
+        response = self.recv_batch_from_client(decode)
+        assert len(response.message) == 1
+        response.message = response.message[0]
+        return response
+
+    def send_to_worker(self, worker, client, uuid, message, headers=None):
+        self.send_envelope([worker, client], uuid, [message], headers)
+
+    def recv_from_worker(self, decode=True):
+        response = self.recv_batch_from_worker(decode)
+        assert len(response.message) == 1
+        response.message = response.message[0]
+        return response
+
+    def send_to_service(self, uuid, message, headers=None):
+        self.send_envelope([], uuid, [message], headers)
+
+    def recv_from_service(self, decode=True):
+        response = self.recv_batch_from_service(decode)
+        assert len(response.message) == 1
+        response.message = response.message[0]
+        return response
+
+    def send_batch_to_client(self, client, uuid, messages, headers=None):
+        self.send_envelope([client], uuid, messages, headers)
+
+    def recv_batch_from_client(self, decode=True):
+        """
+        Like recv_from_client but the envelope may carry any number of
+        payloads; the response message is the list of them.
+        """
+        routing, uuid, headers, messages = self.recv_envelope(1, decode)
         return Response(
-            json.loads(frames[6].decode('utf-8')),
-            worker=frames[0],
-            client=frames[2],
-            uuid=frames[4]
+            messages,
+            client=routing[0],
+            uuid=uuid,
+            headers=headers
         )
 
-    def send_to_service(self, uuid, message):
-        self.send_multipart([
-            uuid,
-            Socket.DELIMITER_FRAME,
-            bytes(json.dumps(message).encode('utf-8'))
-        ])
-
-    def recv_from_service(self):
-        frames = self.recv_multipart()
-        assert len(frames) == 3
-        assert frames[1] == Socket.DELIMITER_FRAME
+    def send_batch_to_worker(self, worker, client, uuid, messages,
+                             headers=None):
+        self.send_envelope([worker, client], uuid, messages, headers)
+
+    def recv_batch_from_worker(self, decode=True):
+        routing, uuid, headers, messages = self.recv_envelope(2, decode)
         return Response(
-            json.loads(frames[2].decode('utf-8')),
-            uuid=frames[0]
+            messages,
+            worker=routing[0],
+            client=routing[1],
+            uuid=uuid,
+            headers=headers
         )
 
+    def send_batch_to_service(self, uuid, messages, headers=None):
+        self.send_envelope([], uuid, messages, headers)
+
+    def recv_batch_from_service(self, decode=True):
+        routing, uuid, headers, messages = self.recv_envelope(0, decode)
+        return Response(messages, uuid=uuid, headers=headers)
+
 
 class RouteSocket(Socket):
 
@@ -153,3 +278,21 @@ class RouteSocket(Socket):
         sender, delimiter, message = self.recv_multipart()
         assert Socket.is_signal(message)
         return struct.unpack('I', message)[0]
+
+
+class DealerSocket(Socket):
+    """
+    DEALER socket that frames messages like a REQ socket: an empty
+    delimiter is added to every message sent and removed from every one
+    received. Unlike REQ, sends and receives don't have to alternate.
+    """
+
+    def send_multipart(self, msg_parts, *args, **kwargs):
+        return super(DealerSocket, self).send_multipart(
+            [Socket.DELIMITER_FRAME] + list(msg_parts), *args, **kwargs
+        )
+
+    def recv_multipart(self, *args, **kwargs):
+        frames = super(DealerSocket, self).recv_multipart(*args, **kwargs)
+        assert len(frames[0]) == 0
+        return frames[1:]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import json
+import operator
 
 
 class MessageHandler(object):
@@ -55,3 +56,81 @@ class MessageHandler(object):
             return True
         except (AssertionError, KeyError):
             return False
+
+
+class BatchHandler(object):
+    """
+    Adapts a batch handler (a function taking a list of messages and
+    returning the list of replies) so it also resolves single messages.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __call__(self, message):
+        return self.handler([message])[0]
+
+
+class MessageHandlerIndex(object):
+    """
+    Dispatch index over a sorted list of message handlers.
+
+    Handlers are grouped by shape (the sorted tuple of their property
+    names) and hashed by their property values, so looking up a message
+    costs one dict access per distinct shape instead of one match_in call
+    per handler. Every shape contributes at most one candidate and the
+    winner is the candidate with the lowest rank in the sorted list, which
+    keeps the precedence rules implemented in MessageHandler.__lt__.
+
+    Handlers with unhashable property values (lists, dicts) are matched
+    linearly with match_in.
+    """
+    def __init__(self, message_handlers=()):
+        self.shapes = {}
+        self.unhashable = []
+        self.default = None
+        for rank, message_handler in enumerate(message_handlers):
+            self._add(rank, message_handler)
+
+    def _add(self, rank, message_handler):
+        if not message_handler.message:
+            if self.default is None:
+                self.default = (rank, message_handler)
+            return
+        shape = tuple(sorted(message_handler.message))
+        if shape not in self.shapes:
+            self.shapes[shape] = (operator.itemgetter(*shape), {})
+        getter, buckets = self.shapes[shape]
+        try:
+            # Sorted order is preserved: the first handler wins.
+            buckets.setdefault(getter(message_handler.message),
+                               (rank, message_handler))
+        except TypeError:
+            self.unhashable.append((rank, message_handler))
+
+    def lookup(self, message):
+        best = self.default
+        for getter, buckets in self.shapes.values():
+            try:
+                candidate = buckets.get(getter(message))
+            except (KeyError, TypeError):
+                continue
+            if candidate is not None and \
+                    (best is None or candidate[0] < best[0]):
+                best = candidate
+        for candidate in self.unhashable:
+            if best is not None and best[0] < candidate[0]:
+                break
+            if candidate[1].match_in(message):
+                best = candidate
+                break
+        return best[1] if best is not None else None
+
+
+def pattern_index(patterns):
+    """
+    MessageHandlerIndex over bare patterns, to find the pattern a message
+    matches with the usual precedence rules.
+    """
+    return MessageHandlerIndex(sorted(
+        MessageHandler(pattern, None) for pattern in patterns
+    ))
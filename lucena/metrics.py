@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import bisect
+import time
+
+
+class Histogram(object):
+    """
+    Histogram with fixed bucket bounds: observing a value is a bisect and
+    an increment. Latencies are recorded in milliseconds.
+    """
+
+    LATENCY_BOUNDS = (
+        0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+        2500, 5000, 10000
+    )
+    SIZE_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        # The last bucket counts the values above every bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, snapshot):
+        """
+        Add the values of a snapshot of a histogram with the same bounds.
+        """
+        if snapshot['bounds'] != list(self.bounds):
+            raise ValueError("Histogram bounds differ.")
+        self.counts = [
+            count + other for count, other in zip(self.counts,
+                                                  snapshot['counts'])
+        ]
+        self.count += snapshot['count']
+        self.total += snapshot['sum']
+        self.max = max(self.max, snapshot['max'])
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile.
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+        }
+
+
+class HandlerMetrics(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class WorkerMetrics(object):
+    """
+    Request and error counts and latency histograms per handler, keyed by
+    the handler message key, plus the time a worker spent in handlers.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.busy_time = 0.0
+        self.started = time.monotonic()
+
+    def observe(self, key, elapsed, errors=0, requests=1):
+        handler_metrics = self.handlers.get(key)
+        if handler_metrics is None:
+            handler_metrics = self.handlers[key] = HandlerMetrics()
+        handler_metrics.requests += requests
+        handler_metrics.errors += errors
+        handler_metrics.latency.observe(elapsed * 1000)
+        self.busy_time += elapsed
+
+    def snapshot(self):
+        uptime = time.monotonic() - self.started
+        return {
+            'handlers': {
+                key: handler_metrics.snapshot()
+                for key, handler_metrics in self.handlers.items()
+            },
+            'busy_time': self.busy_time,
+            'idle_time': max(0.0, uptime - self.busy_time),
+        }
+
+
+def merge_handlers(snapshots):
+    """
+    Handler metrics of several WorkerMetrics snapshots added up, e.g. of
+    every worker of a Service.
+    """
+    handlers = {}
+    for snapshot in snapshots:
+        for key, handler in snapshot['handlers'].items():
+            merged = handlers.get(key)
+            if merged is None:
+                merged = handlers[key] = HandlerMetrics()
+            merged.requests += handler['requests']
+            merged.errors += handler['errors']
+            merged.latency.merge(handler['latency'])
+    return {key: merged.snapshot() for key, merged in handlers.items()}
+
+
+class BrokerMetrics(object):
+    """
+    Queue depth and dispatch latency (time queued before a worker takes
+    the request) of a Service, plus the busy time of every worker as seen
+    by the broker, from dispatch to reply.
+    """
+
+    def __init__(self):
+        self.queue_depth = Histogram(Histogram.SIZE_BOUNDS)
+        self.dispatch_latency = Histogram()
+        self.workers = {}
+        self.started = time.monotonic()
+
+    def observe_dispatch(self, elapsed):
+        self.dispatch_latency.observe(elapsed * 1000)
+
+    def observe_reply(self, worker_id, elapsed):
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            worker = self.workers[worker_id] = {'requests': 0, 'busy': 0.0}
+        worker['requests'] += 1
+        worker['busy'] += elapsed
+
+    def snapshot(self):
+        uptime = time.monotonic() - self.started
+        return {
+            'queue_depth': self.queue_depth.snapshot(),
+            'dispatch_latency': self.dispatch_latency.snapshot(),
+            'workers': {
+                worker_id.decode('utf8'): {
+                    'requests': worker['requests'],
+                    'busy_time': worker['busy'],
+                    'idle_time': max(0.0, uptime - worker['busy']),
+                    'utilization': worker['busy'] / uptime if uptime else 0,
+                }
+                for worker_id, worker in self.workers.items()
+            },
+        }
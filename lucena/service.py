@@ -1,16 +1,78 @@
 # -*- coding: utf-8 -*-
+import collections
+import itertools
+import logging
 import tempfile
 import threading
+import time
+import uuid
 
 import zmq
 
-from lucena.exceptions import ServiceAlreadyStarted, ServiceNotStarted
-from lucena.io2.socket import Socket
+from lucena.exceptions import ServiceAlreadyStarted, ServiceNotStarted, \
+    WorkerStartupTimeout
+from lucena.io2.socket import DealerSocket, Socket, deadline_expired, \
+    trace_event
+from lucena.message_handler import MessageHandler, pattern_index
+from lucena.metrics import BrokerMetrics, merge_handlers
 from lucena.worker import Worker
 
 
+logger = logging.getLogger(__name__)
+
+
 class Service(Worker):
 
+    # Items of a batch request are dispatched to workers on behalf of this
+    # client; their uuid frame is "<batch id>:<item index>".
+    BATCH_CLIENT = b'$batch'
+    # Requests matching a worker batch handler are sent to one worker as a
+    # micro-batch on behalf of this client; the uuid frame is its id.
+    MICRO_BATCH_CLIENT = b'$micro-batch'
+    # Clients of requests forwarded by a lucena.broker.Broker get this
+    # prefix so their replies go back through the broker.
+    BROKER_CLIENT_PREFIX = b'$broker:'
+
+    # Reply sent right away when the pending request queue is full.
+    BUSY_REPLY = {'$rep': None, '$error': 'Service busy'}
+    # Reply of batch items whose deadline passed before dispatch.
+    DEADLINE_REPLY = {'$rep': None, '$error': 'Deadline exceeded'}
+    # Reply of the requests in flight on a dead worker that aren't
+    # idempotent, hence not dispatched again.
+    WORKER_DIED_REPLY = {'$rep': None, '$error': 'Worker died'}
+
+    # Milliseconds to wait for the handler metrics of the workers; the
+    # late ones are reported with their previous snapshot.
+    METRICS_TIMEOUT = 1000
+
+    # Autoscaling hysteresis: consecutive checks needed to add or remove a
+    # worker.
+    SCALE_UP_CHECKS = 2
+    SCALE_DOWN_CHECKS = 5
+
+    Request = collections.namedtuple(
+        'Request',
+        ['client', 'uuid', 'message', 'headers', 'received', 'redeliveries']
+    )
+    # Times the request was dispatched again after its worker died.
+    Request.__new__.__defaults__ = (0,)
+
+    class Batch(object):
+        def __init__(self, client, uuid, size, headers=None):
+            self.client = client
+            self.uuid = uuid
+            self.headers = headers
+            self.replies = [None] * size
+            self.remaining = size
+
+    class MetricsRequest(object):
+        def __init__(self, response, reply_codec, workers):
+            self.response = response
+            self.reply_codec = reply_codec
+            # Workers whose snapshot is still awaited.
+            self.workers = workers
+            self.timer = None
+
     class Controller(Worker.Controller):
 
         def __init__(self, **kwargs):
@@ -23,7 +85,7 @@ class Service(Worker):
         def start(self, **kwargs):
             if self.service_thread is not None:
                 raise ServiceAlreadyStarted()
-            service = Service(**self.kwargs)
+            service = self._create_service()
             self.service_thread = threading.Thread(
                 target=service,
                 daemon=False,
@@ -33,14 +95,28 @@ class Service(Worker):
                 }
             )
             self.service_thread.start()
-            self.wait_for_signal('ready', b'$service')
+            response = self.control_socket.recv_from_worker()
+            if '$error' in response.message:
+                # The workers didn't start in time: the service is gone.
+                self.service_thread.join()
+                self.service_thread = None
+                raise WorkerStartupTimeout(response.message['$error'])
+            assert response.message == {'$signal': 'ready'}
+
+        def _create_service(self):
+            return Service(**self.kwargs)
 
         def stop(self, timeout=None):
             response = self.resolve({'$signal': 'stop'})
             assert response == {'$signal': 'stop', '$rep': 'OK'}
-            self.service_thread.join(timeout=timeout)
+            self.service_thread.join(
+                timeout=timeout / 1000.0 if timeout is not None else None
+            )
             self.service_thread = None
 
+        def metrics(self):
+            return self.resolve({'$req': 'metrics'})['$rep']
+
         def resolve(self, message, timeout=None):
             if not self.is_started():
                 raise ServiceNotStarted()
@@ -51,10 +127,21 @@ class Service(Worker):
     # Service implementation.
 
     def __init__(self, service_name=None, worker_factory=None, endpoint=None,
-                 number_of_workers=1, default_timeout=None):
+                 number_of_workers=1, default_timeout=None, codec=None,
+                 worker_mode=None, batch_size=None, batch_delay=1,
+                 max_pending_requests=None, min_workers=None,
+                 max_workers=None, scale_interval=1000, target_latency=100,
+                 response_cache=None, coalesce_patterns=None,
+                 broker_endpoint=None, prefetch=1, heartbeat_interval=None,
+                 heartbeat_liveness=3, idempotent_patterns=None,
+                 max_redeliveries=2, startup_timeout=None,
+                 stop_timeout=None, broker_heartbeat_interval=1000):
         # http://zguide.zeromq.org/page:all#Getting-the-Context-Right
         # You should create and use exactly one context in your process.
-        super(Service, self).__init__(default_timeout=default_timeout)
+        super(Service, self).__init__(
+            default_timeout=default_timeout,
+            codec=codec
+        )
         if service_name is None:
             service_name = self.__class__.__name__
         self.service_name = service_name
@@ -63,73 +150,883 @@ class Service(Worker):
         self.worker_factory = worker_factory
         self.endpoint = endpoint if endpoint is not None \
             else "ipc://{}.ipc".format(tempfile.NamedTemporaryFile().name)
-        self.number_of_workers = number_of_workers
+        # Autoscaling: every scale_interval milliseconds the pool may grow
+        # or shrink by one worker between min_workers and max_workers.
+        self.min_workers = min_workers if min_workers is not None \
+            else number_of_workers
+        self.max_workers = max_workers if max_workers is not None \
+            else number_of_workers
+        if self.min_workers > self.max_workers:
+            raise ValueError(
+                "Parameter min_workers can't be greater than max_workers."
+            )
+        self.number_of_workers = min(
+            max(number_of_workers, self.min_workers),
+            self.max_workers
+        )
+        self.scale_interval = scale_interval
+        if not isinstance(prefetch, int) or prefetch < 1:
+            raise ValueError(
+                "Parameter prefetch must be a positive integer."
+            )
+        # Credits of every worker: up to prefetch requests are sent to a
+        # worker before it replies, so it starts on the next one without
+        # waiting for a broker round trip.
+        self.prefetch = prefetch
+        # Heartbeats with the workers every heartbeat_interval milliseconds.
+        # A worker silent for heartbeat_liveness intervals, including one
+        # running a handler for that long, is dead: it is replaced and its
+        # requests in flight matching idempotent_patterns are dispatched
+        # again, at most max_redeliveries times; the others get
+        # WORKER_DIED_REPLY. Workers heartbeat between handlers, so the
+        # liveness window must exceed the slowest handler.
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_liveness = heartbeat_liveness
+        self.idempotent_index = None
+        if idempotent_patterns:
+            self.idempotent_index = pattern_index(idempotent_patterns)
+        self.max_redeliveries = max_redeliveries
+        self.last_heartbeats = None
+        # Milliseconds given to the workers to start; after it the service
+        # doesn't start and its controller raises WorkerStartupTimeout.
+        self.startup_timeout = startup_timeout
+        # Milliseconds given to the workers to finish on stop; the ones still
+        # running after it are logged and kept in late_workers.
+        self.stop_timeout = stop_timeout
+        self.late_workers = []
+        # Queued requests waiting longer than this (milliseconds, estimated
+        # from the recent handler latency) call for more workers.
+        self.target_latency = target_latency
+        self.worker_mode = worker_mode
+        # Micro-batching: up to batch_size requests matching a batch
+        # handler are collected for at most batch_delay milliseconds.
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        # High-water mark of the pending request queue. Without it, client
+        # requests wait in the socket while every worker is busy.
+        self.max_pending_requests = max_pending_requests
+        # Optional lucena.cache.ResponseCache: hits are answered by the
+        # broker without reaching a worker.
+        self.response_cache = response_cache
+        self.cache_requests = None
+        # Identical concurrent requests matching these patterns are sent
+        # to a single worker and its reply is shared by all of them.
+        self.coalesce_index = None
+        if coalesce_patterns:
+            self.coalesce_index = pattern_index(coalesce_patterns)
+        self.coalesced_requests = None
+        self.coalescing_leaders = None
+        # Backend endpoint of a lucena.broker.Broker to register with, under
+        # service_name, besides serving the own endpoint.
+        self.broker_endpoint = broker_endpoint
+        self.broker_socket = None
+        # Heartbeats with the broker every broker_heartbeat_interval
+        # milliseconds. After heartbeat_liveness intervals without hearing
+        # from it, e.g. when it restarted, the Service registers again.
+        self.broker_heartbeat_interval = broker_heartbeat_interval
+        self.last_broker_message = None
         self.socket = None
         self.worker_controller = None
-        self.worker_ready_ids = None
+        self.worker_credits = None
+        self.in_flight_requests = None
+        self.pending_requests = None
+        self.batches = None
+        self.batch_ids = itertools.count()
+        self.batch_index = None
+        self.micro_batches = None
+        self.micro_batch_timers = None
+        self.micro_batches_in_flight = None
+        self.last_reply_times = None
+        self.latency = None
+        self.broker_metrics = None
+        self.worker_metrics = None
+        self.metrics_requests = None
+        self.scale_up_checks = 0
+        self.scale_down_checks = 0
         self.total_client_requests = 0
+        self.total_busy_replies = 0
+        self.total_expired_requests = 0
+        self.total_coalesced_requests = 0
+        self.total_dead_workers = 0
+        self.max_queue_depth = 0
 
     def _before_start(self):
         super(Service, self)._before_start()
-        self.worker_ready_ids = []
-        self.socket = Socket(self.context, zmq.ROUTER)
-        self.socket.bind(self.endpoint)
+        # One entry per credit: dispatching pops a worker from the left and
+        # its reply gives the credit back on the right.
+        self.worker_credits = collections.deque()
+        # Dispatch time and request of the requests in flight, in order, by
+        # worker.
+        self.in_flight_requests = {}
+        self.last_heartbeats = {}
+        self.pending_requests = collections.deque()
+        self.batches = {}
+        self.micro_batches = {}
+        self.micro_batch_timers = {}
+        self.micro_batches_in_flight = {}
+        # Time of the last reply by worker.
+        self.last_reply_times = {}
+        self.latency = None
+        self.broker_metrics = BrokerMetrics()
+        # Last handler metrics snapshot by worker, kept after the worker
+        # is gone so its requests still count.
+        self.worker_metrics = {}
+        self.metrics_requests = []
+        # Cacheable requests waiting for a worker reply, by (client, uuid).
+        self.cache_requests = {}
+        # Requests waiting on an identical one in flight, by message key,
+        # and the key of each of those in-flight requests by (client, uuid).
+        self.coalesced_requests = {}
+        self.coalescing_leaders = {}
         self.worker_controller = Worker.Controller(
-            worker_factory=self.worker_factory
-        )
-        self.worker_ready_ids = self.worker_controller.start(
-            self.number_of_workers
+            worker_factory=self.worker_factory,
+            codec=self.codec,
+            worker_mode=self.worker_mode,
+            heartbeat_interval=self.heartbeat_interval,
+            heartbeat_liveness=self.heartbeat_liveness
         )
+        try:
+            worker_ids = self.worker_controller.start(
+                self.number_of_workers,
+                timeout=self.startup_timeout
+            )
+        except WorkerStartupTimeout:
+            self.worker_controller.control_socket.close()
+            raise
+        # Bound once the workers are up, so a failed start leaves the
+        # endpoint free.
+        self.socket = Socket(self.context, zmq.ROUTER, codec=self.codec)
+        self.socket.bind(self.endpoint)
+        for worker_id in worker_ids:
+            self._add_worker(worker_id, credits=0)
+        # Interleaved, so a burst is spread across the workers.
+        self.worker_credits.extend(worker_ids * self.prefetch)
+        self.batch_index = None
+        if self.batch_size is not None and self.batch_size > 1:
+            self.batch_index = pattern_index(self._worker_batch_patterns())
         self._add_poll_handler(
             self.socket,
-            zmq.POLLIN if self.worker_ready_ids else 0,
+            self._socket_flags(),
             self._handle_socket
         )
+        if self.broker_endpoint is not None:
+            self._register_with_broker()
+            self._add_timer(
+                self.broker_heartbeat_interval / 1000.0,
+                self._heartbeat_broker,
+                interval=self.broker_heartbeat_interval / 1000.0
+            )
         self._add_poll_handler(
             self.worker_controller.control_socket,
             zmq.POLLIN,
             self._handle_worker_controller
         )
+        if self.min_workers < self.max_workers:
+            self._add_timer(
+                self.scale_interval / 1000.0,
+                self._autoscale,
+                interval=self.scale_interval / 1000.0
+            )
 
     def _before_stop(self):
         super(Service, self)._before_stop()
+        if self.broker_socket is not None:
+            self.broker_socket.send_to_client(
+                b'$broker',
+                b'$uuid',
+                {'$signal': 'unregister'}
+            )
+        # Requests already dispatched finish and their replies still reach
+        # the clients before the socket is closed.
+        self.late_workers = self.worker_controller.stop(
+            timeout=self.stop_timeout,
+            handle_response=self._handle_worker_reply
+        )
         self.socket.close()
-        self.worker_controller.stop()
+        if self.broker_socket is not None:
+            self.broker_socket.close()
+            self.broker_socket = None
 
-    def _handle_socket(self):
-        assert len(self.worker_ready_ids) > 0
-        response = self.socket.recv_from_client()
-        worker_name = self.worker_ready_ids.pop(0)
+    def _register_with_broker(self):
+        identity = '{}#{}'.format(self.service_name, uuid.uuid4().hex)
+        self.broker_socket = DealerSocket(
+            self.context,
+            zmq.DEALER,
+            identity=identity.encode('utf8'),
+            codec=self.codec
+        )
+        self.broker_socket.setsockopt(zmq.LINGER, 0)
+        self.broker_socket.connect(self.broker_endpoint)
+        self.last_broker_message = time.monotonic()
+        self.broker_socket.send_to_client(
+            b'$broker',
+            b'$uuid',
+            {'$signal': 'register', 'service': self.service_name}
+        )
+        self._add_poll_handler(
+            self.broker_socket,
+            self._socket_flags(),
+            self._handle_broker_socket
+        )
+
+    def _heartbeat_broker(self):
+        expiry = self.broker_heartbeat_interval * self.heartbeat_liveness
+        if time.monotonic() - self.last_broker_message > expiry / 1000.0:
+            logger.warning(
+                "Broker %s missed its heartbeats: registering again",
+                self.broker_endpoint
+            )
+            self._remove_poll_handler(self.broker_socket)
+            self.broker_socket.close()
+            self._register_with_broker()
+            return
+        self.broker_socket.send_to_client(b'$broker', b'$uuid', self.HEARTBEAT)
+
+    def _worker_batch_patterns(self):
         self.worker_controller.send(
-            worker_name,
-            response.client,
-            response.uuid,
-            response.message
+            self.worker_credits[0],
+            b'$controller',
+            b'$uuid',
+            {'$req': 'eval', '$attr': 'batch_patterns'}
         )
-        self.total_client_requests += 1
+        response = self.worker_controller.recv()
+        while response.message == self.HEARTBEAT:
+            response = self.worker_controller.recv()
+        return response.message['$rep']
+
+    def _handle_socket(self):
+        # The broker only routes: payloads are forwarded undecoded.
+        self._handle_client_request(
+            self.socket.recv_batch_from_client(decode=False)
+        )
+
+    def _handle_broker_socket(self):
+        response = self.broker_socket.recv_batch_from_client(decode=False)
+        self.last_broker_message = time.monotonic()
+        if response.client == b'$broker':
+            # Heartbeat of the broker.
+            return
+        response.client = self.BROKER_CLIENT_PREFIX + response.client
+        self._handle_client_request(response)
+
+    def _send_to_client(self, client, uuid, messages, headers=None):
+        if client.startswith(self.BROKER_CLIENT_PREFIX):
+            self.broker_socket.send_batch_to_client(
+                client[len(self.BROKER_CLIENT_PREFIX):],
+                uuid,
+                messages,
+                headers
+            )
+        else:
+            self.socket.send_batch_to_client(client, uuid, messages, headers)
+
+    def _handle_client_request(self, response):
+        received = time.monotonic()
+        trace_event(response.headers, 'broker_receive')
+        messages = response.message
+        # Only the requests left without a worker credit are queued.
+        queued = max(len(messages) - self.available_credits, 0)
+        if self.max_pending_requests is not None and \
+                self.queue_depth + queued > self.max_pending_requests:
+            # Fail fast instead of letting the client time out.
+            self.total_busy_replies += 1
+            self._send_to_client(
+                response.client,
+                response.uuid,
+                [self.BUSY_REPLY] * len(messages),
+                response.headers
+            )
+            return
+        if len(messages) == 1:
+            self._enqueue(self.Request(
+                response.client,
+                response.uuid,
+                messages[0],
+                response.headers,
+                received
+            ))
+        else:
+            # Fan the batch out across the workers, one item per request.
+            batch_id = next(self.batch_ids)
+            self.batches[batch_id] = self.Batch(
+                response.client,
+                response.uuid,
+                len(messages),
+                response.headers
+            )
+            for index, message in enumerate(messages):
+                self._enqueue(self.Request(
+                    self.BATCH_CLIENT,
+                    '{}:{}'.format(batch_id, index).encode('utf-8'),
+                    message,
+                    response.headers,
+                    received
+                ))
+        self.total_client_requests += len(messages)
+        self._dispatch()
+        queue_depth = self.queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self.broker_metrics.queue_depth.observe(queue_depth)
+
+    def _enqueue(self, request, requeued=False):
+        message = self._inspect(request.message)
+        if message is not None:
+            if self._reply_from_cache(request, message):
+                return
+            if self._coalesce(request, message, count=not requeued):
+                return
+        batch_handler = self._batch_handler_for(message)
+        if batch_handler is None:
+            self.pending_requests.append(request)
+            return
+        key = batch_handler.key
+        requests = self.micro_batches.setdefault(key, [])
+        requests.append(request)
+        if len(requests) >= self.batch_size:
+            self._flush_micro_batch(key)
+        elif len(requests) == 1:
+            self.micro_batch_timers[key] = self._add_timer(
+                self.batch_delay / 1000.0,
+                lambda: self._flush_micro_batch(key, dispatch=True)
+            )
+
+    def _inspect(self, payload):
+        # Payloads are only decoded when a feature has to look inside.
+        if self.response_cache is None and self.coalesce_index is None \
+                and self.batch_index is None \
+                and self.idempotent_index is None:
+            return None
+        try:
+            message = Socket.decode(payload)
+        except ValueError:
+            return None
+        return message if isinstance(message, dict) else None
+
+    def _reply_from_cache(self, request, message):
+        if self.response_cache is None:
+            return False
+        cache_key = self.response_cache.key_for(message)
+        if cache_key is None:
+            return False
+        payload = self.response_cache.get(cache_key)
+        if payload is None:
+            # Cache the reply when the worker sends it.
+            self.cache_requests[(request.client, request.uuid)] = cache_key
+            return False
+        self._reply(request.client, request.uuid, payload, request.headers)
+        return True
+
+    def _coalesce(self, request, message, count=True):
+        if self.coalesce_index is None or \
+                self.coalesce_index.lookup(message) is None:
+            return False
+        key = MessageHandler(message, None).key
+        waiting = self.coalesced_requests.get(key)
+        if waiting is not None:
+            waiting.append(request)
+            # A waiter taken over by a new leader is only counted once.
+            if count:
+                self.total_coalesced_requests += 1
+            return True
+        self.coalesced_requests[key] = []
+        self.coalescing_leaders[(request.client, request.uuid)] = key
+        return False
+
+    def _cache_reply(self, cache_key, message):
+        if isinstance(message, zmq.Frame):
+            message = message.bytes
+        if not isinstance(message, bytes):
+            return
+        try:
+            reply = Socket.decode(message)
+        except ValueError:
+            return
+        # Errors, e.g. an exceeded deadline, are not cached.
+        if isinstance(reply, dict) and not reply.get('$error'):
+            self.response_cache.put(cache_key, message)
+
+    def _batch_handler_for(self, message):
+        if self.batch_index is None or message is None:
+            return None
+        return self.batch_index.lookup(message)
+
+    def _flush_micro_batch(self, key, dispatch=False):
+        requests = []
+        for request in self.micro_batches.pop(key):
+            if deadline_expired(request.headers):
+                self._expire(request)
+            else:
+                requests.append(request)
+        self._cancel_timer(self.micro_batch_timers.pop(key))
+        if len(requests) == 1:
+            self.pending_requests.append(requests[0])
+        elif requests:
+            batch_id = next(self.batch_ids)
+            self.micro_batches_in_flight[batch_id] = requests
+            deadlines = [
+                (request.headers or {}).get('deadline')
+                for request in requests
+            ]
+            headers = {}
+            if None not in deadlines:
+                headers['deadline'] = max(deadlines)
+            # The worker stamps a trace of its own, copied back onto the
+            # traces of the sampled requests.
+            if any((request.headers or {}).get('trace') is not None
+                   for request in requests):
+                headers['trace'] = {}
+            self.pending_requests.append(self.Request(
+                self.MICRO_BATCH_CLIENT,
+                str(batch_id).encode('utf-8'),
+                [request.message for request in requests],
+                headers or None,
+                min(request.received for request in requests)
+            ))
+        if dispatch:
+            self._dispatch()
 
     def _handle_worker_controller(self):
-        response = self.worker_controller.recv()
-        self.worker_ready_ids.append(response.worker)
-        # TODO: Verify if client is still waiting the reply (timeout happens)
-        self.socket.send_to_client(
-            response.client,
-            response.uuid,
-            response.message
+        response = self.worker_controller.recv_batch(decode=False)
+        now = time.monotonic()
+        worker_id = response.worker
+        if worker_id in self.last_heartbeats:
+            self.last_heartbeats[worker_id] = now
+        if response.client == b'$controller':
+            self._handle_worker_signal(response)
+            self._dispatch()
+            return
+        if worker_id not in self.in_flight_requests:
+            # Late reply of a dead worker: its requests were already
+            # dispatched again or answered.
+            return
+        self.worker_credits.append(worker_id)
+        dispatched, _ = self.in_flight_requests[worker_id].popleft()
+        # A prefetched request waits in the worker until the previous one
+        # is answered: its service time starts at the later of both.
+        start = max(dispatched, self.last_reply_times.get(worker_id, 0))
+        self.last_reply_times[worker_id] = now
+        elapsed = now - start
+        self.broker_metrics.observe_reply(worker_id, elapsed)
+        # Exponentially weighted moving average, in milliseconds.
+        latency = elapsed * 1000
+        self.latency = latency if self.latency is None \
+            else 0.8 * self.latency + 0.2 * latency
+        self._handle_worker_reply(response)
+        self._dispatch()
+
+    def _handle_worker_reply(self, response):
+        if response.client == self.MICRO_BATCH_CLIENT:
+            requests = self.micro_batches_in_flight.pop(int(response.uuid))
+            for request, message in zip(requests, response.message):
+                self._copy_trace(response.headers, request.headers)
+                self._reply(
+                    request.client,
+                    request.uuid,
+                    message,
+                    request.headers
+                )
+        else:
+            self._reply(
+                response.client,
+                response.uuid,
+                response.message[0],
+                response.headers
+            )
+
+    @staticmethod
+    def _copy_trace(source, headers):
+        """
+        Copy the dispatch and handler stamps of a worker reply onto the
+        trace of a request it answered. The trace of a batch spans all of
+        its requests: from the first dispatch to the last handler end.
+        """
+        source = (source or {}).get('trace')
+        trace = (headers or {}).get('trace')
+        if not source or trace is None or source is trace:
+            return
+        for event in ('dispatch', 'handler_start', 'handler_end'):
+            if event not in source:
+                continue
+            if event not in trace:
+                trace[event] = source[event]
+            elif event == 'handler_end':
+                trace[event] = max(trace[event], source[event])
+            else:
+                trace[event] = min(trace[event], source[event])
+
+    def _handle_worker_signal(self, response):
+        message = Socket.decode(response.message[0])
+        if message.get('$req') == 'metrics':
+            self._handle_worker_metrics(response.worker, message['$rep'])
+        elif message == {'$signal': 'ready'}:
+            # A worker added by autoscaling or replacing a dead one joins
+            # the pool.
+            self._add_worker(response.worker)
+        elif message.get('$signal') == 'stop' and \
+                response.worker in self.worker_controller.running_workers:
+            self.worker_controller.join_worker(response.worker)
+
+    def _add_worker(self, worker_id, credits=None):
+        self.in_flight_requests[worker_id] = collections.deque()
+        if self.heartbeat_interval is not None:
+            self.last_heartbeats[worker_id] = time.monotonic()
+        self.worker_credits.extend(
+            [worker_id] * (self.prefetch if credits is None else credits)
+        )
+
+    def _remove_worker(self, worker_id):
+        self.worker_controller.remove_worker(worker_id)
+        self._forget_worker(worker_id)
+
+    def _forget_worker(self, worker_id):
+        for request in self.metrics_requests:
+            request.workers.discard(worker_id)
+        self._reply_metrics_requests()
+        del self.in_flight_requests[worker_id]
+        self.last_heartbeats.pop(worker_id, None)
+        self.last_reply_times.pop(worker_id, None)
+        self.worker_credits = collections.deque(
+            credit for credit in self.worker_credits if credit != worker_id
+        )
+
+    def _heartbeat(self):
+        # Run by the Worker heartbeat timer: a Service heartbeats its
+        # workers, not its own controller.
+        now = time.monotonic()
+        expiry = self.heartbeat_interval * self.heartbeat_liveness / 1000.0
+        for worker_id, last_heartbeat in list(self.last_heartbeats.items()):
+            if now - last_heartbeat > expiry:
+                self._replace_dead_worker(worker_id)
+            else:
+                self.worker_controller.send(
+                    worker_id,
+                    b'$controller',
+                    b'$uuid',
+                    self.HEARTBEAT
+                )
+        self._dispatch()
+
+    def _replace_dead_worker(self, worker_id):
+        logger.warning(
+            "Worker %s missed its heartbeats: replacing it",
+            worker_id.decode('utf8')
+        )
+        self.total_dead_workers += 1
+        requests = [
+            request for _, request in self.in_flight_requests[worker_id]
+        ]
+        self._forget_worker(worker_id)
+        self.worker_controller.discard_worker(worker_id)
+        abandoned_workers = self.worker_controller.abandoned_workers()
+        if abandoned_workers:
+            # Threads can't be killed: hung ones keep running until their
+            # handler returns.
+            logger.warning(
+                "Discarded worker threads still running: %s",
+                ", ".join(
+                    worker_id.decode('utf8')
+                    for worker_id in abandoned_workers
+                )
+            )
+        self.worker_controller.add_worker(wait=False)
+        # Dispatched again first, in their original order.
+        for request in reversed(requests):
+            if self._is_idempotent(request) and \
+                    request.redeliveries < self.max_redeliveries:
+                self.pending_requests.appendleft(
+                    request._replace(redeliveries=request.redeliveries + 1)
+                )
+            else:
+                self._fail(request)
+
+    def _is_idempotent(self, request):
+        if self.idempotent_index is None:
+            return False
+        if request.client == self.MICRO_BATCH_CLIENT:
+            return all(
+                self._is_idempotent(item)
+                for item in self.micro_batches_in_flight[int(request.uuid)]
+            )
+        message = self._inspect(request.message)
+        return message is not None and \
+            self.idempotent_index.lookup(message) is not None
+
+    def _fail(self, request):
+        if request.client == self.MICRO_BATCH_CLIENT:
+            for item in self.micro_batches_in_flight.pop(int(request.uuid)):
+                self._fail(item)
+            return
+        self._reply(
+            request.client,
+            request.uuid,
+            self.WORKER_DIED_REPLY,
+            request.headers
         )
 
+    def _idle_workers(self):
+        return [
+            worker_id
+            for worker_id, requests in self.in_flight_requests.items()
+            if not requests
+        ]
+
+    def _autoscale(self):
+        queue_depth = self.queue_depth
+        # Estimated wait of the queued requests with the current pool.
+        wait = queue_depth * (self.latency or 0) / self.number_of_workers
+        if queue_depth and (self.latency is None or
+                            wait > self.target_latency):
+            self.scale_up_checks += 1
+            self.scale_down_checks = 0
+        elif not queue_depth and len(self._idle_workers()) > 1:
+            self.scale_down_checks += 1
+            self.scale_up_checks = 0
+        else:
+            self.scale_up_checks = 0
+            self.scale_down_checks = 0
+        if self.scale_up_checks >= self.SCALE_UP_CHECKS and \
+                self.number_of_workers < self.max_workers:
+            self.worker_controller.add_worker(wait=False)
+            self.number_of_workers += 1
+            self.scale_up_checks = 0
+        elif self.scale_down_checks >= self.SCALE_DOWN_CHECKS and \
+                self.number_of_workers > self.min_workers:
+            self._remove_worker(self._idle_workers()[-1])
+            self.number_of_workers -= 1
+            self.scale_down_checks = 0
+
+    def _reply(self, client, uuid, message, headers=None):
+        cache_key = self.cache_requests.pop((client, uuid), None)
+        if cache_key is not None:
+            self._cache_reply(cache_key, message)
+        key = self.coalescing_leaders.pop((client, uuid), None)
+        if key is not None:
+            waiting = self.coalesced_requests.pop(key)
+            if waiting and isinstance(message, zmq.Frame):
+                message = message.bytes
+            for request in waiting:
+                self._reply(
+                    request.client,
+                    request.uuid,
+                    message,
+                    request.headers
+                )
+        if client == self.BATCH_CLIENT:
+            self._handle_batch_reply(uuid, message, headers)
+        elif deadline_expired(headers):
+            # The client is no longer waiting for this reply.
+            self.total_expired_requests += 1
+        else:
+            trace_event(headers, 'broker_reply')
+            self._send_to_client(client, uuid, [message], headers)
+
+    def _expire(self, request):
+        if request.client == self.MICRO_BATCH_CLIENT:
+            for item in self.micro_batches_in_flight.pop(int(request.uuid)):
+                self._expire(item)
+            return
+        self.total_expired_requests += 1
+        self.cache_requests.pop((request.client, request.uuid), None)
+        key = self.coalescing_leaders.pop((request.client, request.uuid), None)
+        if key is not None:
+            # The first waiting request still in time takes over.
+            for waiting in self.coalesced_requests.pop(key):
+                self._enqueue(waiting, requeued=True)
+        if request.client == self.BATCH_CLIENT:
+            self._handle_batch_reply(request.uuid, self.DEADLINE_REPLY)
+
+    def _handle_batch_reply(self, uuid, message, headers=None):
+        batch_id, index = [int(n) for n in uuid.split(b':')]
+        batch = self.batches[batch_id]
+        self._copy_trace(headers, batch.headers)
+        batch.replies[index] = message
+        batch.remaining -= 1
+        if not batch.remaining:
+            del self.batches[batch_id]
+            if deadline_expired(batch.headers):
+                return
+            trace_event(batch.headers, 'broker_reply')
+            self._send_to_client(
+                batch.client,
+                batch.uuid,
+                batch.replies,
+                batch.headers
+            )
+
+    def _dispatch(self):
+        while self.pending_requests and self.worker_credits:
+            request = self.pending_requests.popleft()
+            if deadline_expired(request.headers):
+                self._expire(request)
+                continue
+            if request.client == self.MICRO_BATCH_CLIENT:
+                send = self.worker_controller.send_batch
+            else:
+                send = self.worker_controller.send
+            worker_id = self.worker_credits.popleft()
+            now = time.monotonic()
+            self.in_flight_requests[worker_id].append((now, request))
+            self.broker_metrics.observe_dispatch(now - request.received)
+            trace_event(request.headers, 'dispatch')
+            send(
+                worker_id,
+                request.client,
+                request.uuid,
+                request.message,
+                request.headers
+            )
+        flags = self._socket_flags()
+        self._update_poll_handler(self.socket, flags)
+        if self.broker_socket is not None:
+            self._update_poll_handler(self.broker_socket, flags)
+
+    def _socket_flags(self):
+        # Without a bounded queue, leave new requests in the socket until a
+        # worker has a credit; with it, keep reading to answer busy when full.
+        # Autoscaling also keeps reading: it sizes the pool from the queue.
+        if self.worker_credits or self.max_pending_requests is not None \
+                or self.min_workers < self.max_workers:
+            return zmq.POLLIN
+        return 0
+
+    @property
+    def queue_depth(self):
+        if self.pending_requests is None:
+            return 0
+        return len(self.pending_requests) + sum(
+            len(requests) for requests in self.micro_batches.values()
+        )
+
+    def _handle_ctrl_request(self, response, reply_codec):
+        if response.client == b'$controller' and \
+                response.message == [{'$req': 'metrics'}]:
+            self._collect_worker_metrics(response, reply_codec)
+        else:
+            super(Service, self)._handle_ctrl_request(response, reply_codec)
+
+    def _collect_worker_metrics(self, response, reply_codec):
+        """
+        Ask every worker for its handler metrics and reply to the
+        controller once all of them answered, or after METRICS_TIMEOUT.
+        A busy worker answers after the requests already sent to it.
+        """
+        request = self.MetricsRequest(
+            response,
+            reply_codec,
+            set(self.in_flight_requests)
+        )
+        for worker_id in request.workers:
+            self.worker_controller.send(
+                worker_id,
+                b'$controller',
+                b'$metrics',
+                {'$req': 'metrics'}
+            )
+        request.timer = self._add_timer(
+            self.METRICS_TIMEOUT / 1000.0,
+            lambda: self._reply_metrics(request)
+        )
+        self.metrics_requests.append(request)
+        self._reply_metrics_requests()
+
+    def _handle_worker_metrics(self, worker_id, snapshot):
+        self.worker_metrics[worker_id] = snapshot
+        for request in self.metrics_requests:
+            request.workers.discard(worker_id)
+        self._reply_metrics_requests()
+
+    def _reply_metrics_requests(self):
+        for request in list(self.metrics_requests):
+            if not request.workers:
+                self._reply_metrics(request)
+
+    def _reply_metrics(self, request):
+        self._cancel_timer(request.timer)
+        self.metrics_requests.remove(request)
+        self._send_ctrl_replies(
+            request.response,
+            [self.handler_metrics(request.response.message[0])],
+            request.reply_codec
+        )
+
+    def get_metrics(self):
+        """
+        Broker metrics and the handler metrics of all the workers, added
+        up. Service.Controller.metrics() collects the worker snapshots
+        first; a client request {'$req': 'metrics'} is served by a single
+        worker and returns its own handler metrics.
+        """
+        metrics = self.broker_metrics.snapshot()
+        metrics.update({
+            'handlers': merge_handlers(self.worker_metrics.values()),
+            'client_requests': self.total_client_requests,
+            'busy_replies': self.total_busy_replies,
+            'expired_requests': self.total_expired_requests,
+            'coalesced_requests': self.total_coalesced_requests,
+            'dead_workers': self.total_dead_workers,
+            'abandoned_workers': len(
+                self.worker_controller.abandoned_workers()
+            ),
+            'pending_requests': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'number_of_workers': self.number_of_workers,
+            'available_credits': self.available_credits,
+            'cache': self.cache_stats,
+        })
+        return metrics
+
+    @property
+    def available_credits(self):
+        if self.worker_credits is None:
+            return 0
+        return len(self.worker_credits)
+
+    @property
+    def cache_stats(self):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.stats()
+
     @property
     def pending_workers(self):
-        return self.worker_ready_ids is not None and \
-               len(self.worker_ready_ids) < self.number_of_workers
+        return self.in_flight_requests is not None and \
+               len(self._idle_workers()) < self.number_of_workers
 
 
 def create_service(service_name, worker_factory=None, endpoint=None,
-                   number_of_workers=1):
+                   number_of_workers=1, codec=None, worker_mode=None,
+                   batch_size=None, batch_delay=1, max_pending_requests=None,
+                   min_workers=None, max_workers=None, scale_interval=1000,
+                   target_latency=100, response_cache=None,
+                   coalesce_patterns=None, broker_endpoint=None,
+                   prefetch=1, heartbeat_interval=None, heartbeat_liveness=3,
+                   idempotent_patterns=None, max_redeliveries=2,
+                   startup_timeout=None, stop_timeout=None,
+                   broker_heartbeat_interval=1000):
     return Service.Controller(
         service_name=service_name,
         worker_factory=worker_factory,
         endpoint=endpoint,
         number_of_workers=number_of_workers,
-        default_timeout=None
+        default_timeout=None,
+        codec=codec,
+        worker_mode=worker_mode,
+        batch_size=batch_size,
+        batch_delay=batch_delay,
+        max_pending_requests=max_pending_requests,
+        min_workers=min_workers,
+        max_workers=max_workers,
+        scale_interval=scale_interval,
+        target_latency=target_latency,
+        response_cache=response_cache,
+        coalesce_patterns=coalesce_patterns,
+        broker_endpoint=broker_endpoint,
+        prefetch=prefetch,
+        heartbeat_interval=heartbeat_interval,
+        heartbeat_liveness=heartbeat_liveness,
+        idempotent_patterns=idempotent_patterns,
+        max_redeliveries=max_redeliveries,
+        startup_timeout=startup_timeout,
+        stop_timeout=stop_timeout,
+        broker_heartbeat_interval=broker_heartbeat_interval
     )
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import random
+import threading
+import time
+import uuid
+
+
+class Tracer(object):
+    """
+    Samples client requests for tracing. A sampled request carries a trace
+    object in its headers frame; every hop adds its timestamp:
+
+        client_send, broker_receive, dispatch, handler_start, handler_end,
+        broker_reply, client_receive
+
+    Completed traces, with the time between hops in milliseconds, are
+    recorded by the sink.
+    """
+
+    EVENTS = (
+        'client_send', 'broker_receive', 'dispatch', 'handler_start',
+        'handler_end', 'broker_reply', 'client_receive'
+    )
+
+    def __init__(self, sink, sample_rate=1.0):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("Parameter sample_rate must be in [0, 1].")
+        self.sink = sink
+        self.sample_rate = sample_rate
+
+    def start(self):
+        """
+        Return a new trace, or None if the request isn't sampled.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        return {'id': uuid.uuid4().hex, 'client_send': time.time()}
+
+    def finish(self, trace):
+        trace['client_receive'] = time.time()
+        events = [event for event in self.EVENTS if event in trace]
+        trace['durations'] = {
+            '{}-{}'.format(start, end): (trace[end] - trace[start]) * 1000
+            for start, end in zip(events, events[1:])
+        }
+        self.sink.record(trace)
+
+
+class MemorySink(object):
+    """
+    Keeps the last capacity traces.
+    """
+
+    def __init__(self, capacity=1024):
+        self.traces = collections.deque(maxlen=capacity)
+
+    def record(self, trace):
+        self.traces.append(trace)
+
+    def close(self):
+        pass
+
+
+class JSONLSink(object):
+    """
+    Appends one JSON object per trace to a file.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def record(self, trace):
+        line = json.dumps(trace) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -1,19 +1,41 @@
 # -*- coding: utf-8 -*-
 import collections
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing
+import tempfile
 import threading
+import time
+
 import zmq
 
 from lucena.exceptions import WorkerAlreadyStarted, WorkerNotStarted, \
-    LookupHandlerError
-from lucena.io2.socket import Socket
-from lucena.message_handler import MessageHandler
+    WorkerStartupTimeout, LookupHandlerError
+from lucena.io2 import codec as payload_codec
+from lucena.io2.socket import DealerSocket, Socket, trace_event
+from lucena.message_handler import BatchHandler, MessageHandler, \
+    MessageHandlerIndex
+from lucena.metrics import WorkerMetrics
+
+
+logger = logging.getLogger(__name__)
 
 
 class Worker(object):
 
+    # Sent both ways between a controller and its workers when heartbeats
+    # are enabled; never replied to.
+    HEARTBEAT = {'$signal': 'heartbeat'}
+    # Reply sent instead of one the request codec can't encode.
+    UNSERIALIZABLE_REPLY = {'$rep': None, '$error': 'Reply not serializable'}
+
+    # The Thread or Process running a worker and, for a thread, the
+    # StartupGate that cancels it while it is still starting.
     RunningWorker = collections.namedtuple(
         'RunningWorker',
-        ['worker', 'thread']
+        ['runner', 'startup']
     )
 
     PollHandler = collections.namedtuple(
@@ -22,18 +44,53 @@ class Worker(object):
     )
 
     class Controller(object):
+        # Worker modes: threads in this process or one process per worker.
+        THREAD = 'thread'
+        PROCESS = 'process'
+        # Milliseconds between checks for workers that exited without
+        # replying to stop.
+        STOP_POLL_INTERVAL = 100
+
         def __init__(self, **kwargs):
             self.context = zmq.Context.instance()
             self.default_timeout = kwargs.get('default_timeout')
+            self.worker_mode = kwargs.get('worker_mode') or self.THREAD
+            if self.worker_mode not in (self.THREAD, self.PROCESS):
+                raise ValueError(
+                    "Parameter worker_mode must be 'thread' or 'process'."
+                )
             self.kwargs = kwargs
             self.running_workers = None
-            self.control_socket = Socket(self.context, zmq.ROUTER)
-            self.control_socket.bind(Socket.inproc_unique_endpoint())
+            # Discarded worker threads, left running until they return.
+            self.discarded_workers = {}
+            self.worker_indexes = itertools.count()
+            self.control_socket = Socket(
+                self.context,
+                zmq.ROUTER,
+                codec=kwargs.get('codec')
+            )
+            # A restarted service reconnects with the same identity before
+            # the old connection is gone: let the new one take over.
+            self.control_socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+            if self.worker_mode == self.PROCESS:
+                # inproc endpoints are not reachable from other processes.
+                self.control_socket.bind("ipc://{}.ipc".format(
+                    tempfile.NamedTemporaryFile().name
+                ))
+            else:
+                self.control_socket.bind(Socket.inproc_unique_endpoint())
 
         def is_started(self):
             return self.running_workers is not None
 
-        def start(self, number_of_workers=1):
+        def start(self, number_of_workers=1, timeout=None):
+            """
+            Start the workers and wait, at most timeout milliseconds, until
+            all of them are ready. On WorkerStartupTimeout the controller is
+            stopped again before raising: the ready workers are stopped, the
+            late processes terminated and the late threads cancelled, so
+            they return as soon as they are built.
+            """
             if self.is_started():
                 raise WorkerAlreadyStarted()
             if not isinstance(number_of_workers, int) or number_of_workers < 1:
@@ -41,66 +98,236 @@ class Worker(object):
                     "Parameter number_of_workers must be a positive integer."
                 )
             self.running_workers = {}
-            for i in range(number_of_workers):
-                worker = self.kwargs.get('worker_factory', Worker)(
-                    **self.kwargs
-                )
-                identity = '$worker#{}'.format(i).encode('utf8')
-                thread = threading.Thread(
-                    target=worker,
-                    daemon=False,
-                    kwargs={
-                        'endpoint': self.control_socket.last_endpoint,
-                        'identity': identity
-                    }
-                )
-                thread.start()
+            self.worker_indexes = itertools.count()
+            # Launch every worker before waiting: their startup runs in
+            # parallel and the ready signals are gathered in any order.
+            identities = [
+                self.add_worker(wait=False) for _ in range(number_of_workers)
+            ]
+            try:
+                self.wait_for_ready(identities, timeout)
+            except WorkerStartupTimeout:
+                self._cancel_start()
+                raise
+            return identities
+
+        def _cancel_start(self):
+            for worker_id, running_worker in list(
+                    self.running_workers.items()):
+                if self.worker_mode == self.PROCESS:
+                    # Ready or not, nothing is lost.
+                    running_worker.runner.terminate()
+                    running_worker.runner.join()
+                    del self.running_workers[worker_id]
+                elif running_worker.startup.cancel():
+                    del self.running_workers[worker_id]
+            # Left: threads already past their gate, which are ready or
+            # about to be; stop resends stop to the late ones.
+            self.stop()
+
+        def add_worker(self, wait=True):
+            """
+            Start one more worker and return its identity. Unless wait is
+            set, the caller receives its ready signal.
+            """
+            if not self.is_started():
+                raise WorkerNotStarted()
+            identity = '$worker#{}'.format(
+                next(self.worker_indexes)
+            ).encode('utf8')
+            running_worker = self._spawn_worker(identity)
+            if wait:
                 self.wait_for_signal('ready', identity)
-                self.running_workers[identity] = Worker.RunningWorker(
-                    worker,
-                    thread
+            self.running_workers[identity] = running_worker
+            return identity
+
+        def remove_worker(self, worker_id):
+            """
+            Ask an idle worker to stop. The caller receives the stop reply
+            and then calls join_worker.
+            """
+            self._send_stop(worker_id)
+
+        def wait_for_ready(self, identities, timeout=None):
+            pending = set(identities)
+            deadline = None
+            if timeout is not None:
+                deadline = time.monotonic() + timeout / 1000.0
+            while pending:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.control_socket.poll(
+                            int(math.ceil(remaining * 1000))):
+                        raise WorkerStartupTimeout(
+                            "Workers not ready: {}".format(", ".join(sorted(
+                                identity.decode('utf8')
+                                for identity in pending
+                            )))
+                        )
+                response = self.control_socket.recv_from_worker()
+                assert response.client == b'$controller'
+                if response.message == Worker.HEARTBEAT:
+                    continue
+                assert response.message == {"$signal": "ready"}
+                pending.discard(response.worker)
+
+        def join_worker(self, worker_id, timeout=None):
+            running_worker = self.running_workers.pop(worker_id)
+            running_worker.runner.join(
+                timeout=timeout / 1000.0 if timeout is not None else None
+            )
+
+        def discard_worker(self, worker_id):
+            """
+            Give up on a dead or hung worker. A process is terminated; a
+            thread can't be, so it is asked to stop and left behind.
+            """
+            running_worker = self.running_workers.pop(worker_id)
+            if self.worker_mode == self.PROCESS:
+                running_worker.runner.terminate()
+                running_worker.runner.join()
+            else:
+                self._send_stop(worker_id)
+                self.discarded_workers[worker_id] = running_worker
+
+        def abandoned_workers(self):
+            """
+            Identities of the discarded worker threads still running.
+            """
+            self.discarded_workers = {
+                worker_id: running_worker
+                for worker_id, running_worker in self.discarded_workers.items()
+                if running_worker.runner.is_alive()
+            }
+            return sorted(self.discarded_workers)
+
+        def _spawn_worker(self, identity):
+            worker_factory = self.kwargs.get('worker_factory', Worker)
+            endpoint = self.control_socket.last_endpoint
+            args = (worker_factory, self.kwargs, endpoint, identity)
+            if self.worker_mode == self.PROCESS:
+                # The worker is built in the child, so worker_factory and
+                # the controller kwargs must be picklable.
+                process = multiprocessing.get_context('spawn').Process(
+                    target=run_worker,
+                    daemon=False,
+                    args=args
                 )
-            return list(self.running_workers.keys())
+                process.start()
+                return Worker.RunningWorker(process, None)
+            # The worker is built in its own thread too, so a slow
+            # worker_factory doesn't hold back the other workers.
+            startup = StartupGate()
+            thread = threading.Thread(
+                target=run_worker,
+                daemon=False,
+                args=args + (startup,)
+            )
+            thread.start()
+            return Worker.RunningWorker(thread, startup)
 
-        def stop(self, timeout=None):
+        def stop(self, timeout=None, handle_response=None):
+            """
+            Broadcast stop to every worker and join them, all under one
+            deadline of timeout milliseconds. A busy worker stops after
+            replying to the requests sent before the stop; those replies
+            are passed to handle_response. Workers that exited without
+            replying, e.g. dead ones, are not waited for. Returns the
+            workers that missed the deadline, including discarded worker
+            threads still running.
+            """
+            deadline = None
+            if timeout is not None:
+                deadline = time.monotonic() + timeout / 1000.0
+            pending = set(self.running_workers)
+            for worker_id in pending:
+                self._send_stop(worker_id)
+            while pending:
+                wait = self.STOP_POLL_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    wait = min(wait, int(math.ceil(remaining * 1000)))
+                if not self.control_socket.poll(wait):
+                    pending = {
+                        worker_id for worker_id in pending
+                        if self.running_workers[worker_id].runner.is_alive()
+                    }
+                    continue
+                response = self.recv_batch(decode=False)
+                if response.client != b'$controller':
+                    if handle_response is not None:
+                        handle_response(response)
+                    continue
+                message = Socket.decode(response.message[0])
+                if message == {'$signal': 'ready'}:
+                    # Started late: the first stop didn't reach it either.
+                    self._send_stop(response.worker)
+                elif message == {'$signal': 'stop', '$rep': 'OK'}:
+                    pending.discard(response.worker)
             for worker_id, running_worker in self.running_workers.items():
-                # TODO: Remove this and try with Poll
-                # TODO: Keep the sequence (REQ1, REP1), (REQ2, REP2), ...
-                for _ in range(2):
-                    self.send(
-                        worker_id,
-                        b'$controller',
-                        b'$uuid',
-                        {'$signal': 'stop'}
-                    )
-                    response = self.recv()
-                    if not worker_id == worker_id:
-                        continue
-                    if not response.client == b'$controller':
-                        continue
-                    if not response.message == {'$signal': 'stop', '$rep': 'OK'}:
-                        continue
-                    running_worker.thread.join(timeout=timeout)
-                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0, deadline - time.monotonic())
+                running_worker.runner.join(timeout=remaining)
+                if running_worker.runner.is_alive():
+                    pending.add(worker_id)
+                else:
+                    # Exited without replying, e.g. it lost its heartbeats.
+                    pending.discard(worker_id)
+            pending.update(self.abandoned_workers())
+            self.discarded_workers = {}
+            if pending:
+                logger.warning(
+                    "Workers still running after stop: %s",
+                    ", ".join(sorted(
+                        worker_id.decode('utf8') for worker_id in pending
+                    ))
+                )
             self.running_workers = None
+            return sorted(pending)
+
+        def _send_stop(self, worker_id):
+            self.send(worker_id, b'$controller', b'$uuid', {'$signal': 'stop'})
 
-        def send(self, worker_id, client_id, uuid, message):
+        def send(self, worker_id, client_id, uuid, message, headers=None):
             if not self.is_started():
                 raise WorkerNotStarted()
             return self.control_socket.send_to_worker(
                 worker_id,
                 client_id,
                 uuid,
-                message
+                message,
+                headers
+            )
+
+        def recv(self, timeout=None, decode=True):
+            if not self.is_started():
+                raise WorkerNotStarted()
+            return self.control_socket.recv_from_worker(decode)
+
+        def send_batch(self, worker_id, client_id, uuid, messages,
+                       headers=None):
+            if not self.is_started():
+                raise WorkerNotStarted()
+            return self.control_socket.send_batch_to_worker(
+                worker_id,
+                client_id,
+                uuid,
+                messages,
+                headers
             )
 
-        def recv(self, timeout=None):
+        def recv_batch(self, decode=True):
             if not self.is_started():
                 raise WorkerNotStarted()
-            return self.control_socket.recv_from_worker()
+            return self.control_socket.recv_batch_from_worker(decode)
 
         def wait_for_signal(self, signal, worker=None):
             response = self.control_socket.recv_from_worker()
+            while response.message == Worker.HEARTBEAT:
+                response = self.control_socket.recv_from_worker()
             if worker is not None:
                 assert response.worker == worker
             assert response.client == b'$controller'
@@ -113,17 +340,39 @@ class Worker(object):
         self.control_socket = None
         self.stop_signal = False
         self.default_timeout = kwargs.get('default_timeout')
-        self.poll_handlers = []
+        self.codec = kwargs.get('codec')
+        # Paranoid Pirate heartbeats, every heartbeat_interval milliseconds:
+        # after heartbeat_liveness intervals without hearing from its
+        # controller the worker stops. The clock starts with the first
+        # message of the controller, which may wait for slower workers to
+        # start before heartbeating. Only enable them with a controller
+        # that heartbeats too, i.e. a Service.
+        self.heartbeat_interval = kwargs.get('heartbeat_interval')
+        self.heartbeat_liveness = kwargs.get('heartbeat_liveness', 3)
+        self.last_controller_message = None
+        self.poll_handlers = {}
+        self.timers = []
+        self.timer_sequence = itertools.count()
         self.message_handlers = []
+        self.message_index = MessageHandlerIndex()
+        self.metrics = WorkerMetrics()
         self.context = zmq.Context.instance()
         self.poller = zmq.Poller()
         self.bind_handler({}, self.handler_default)
         self.bind_handler({'$signal': 'stop'}, self.handler_stop)
         self.bind_handler({'$req': 'eval'}, self.handler_eval)
+        self.bind_handler({'$req': 'metrics'}, self.handler_metrics)
 
     def __call__(self, endpoint, identity):
         self.identity = identity
-        self._before_start()
+        try:
+            self._before_start()
+        except WorkerStartupTimeout as error:
+            # A Service whose workers didn't start: its controller gets the
+            # error instead of the ready signal.
+            self._signal_ready(endpoint, error=str(error))
+            self.control_socket.close()
+            return
         self._signal_ready(endpoint)
         while not self.stop_signal:
             self._handle_poll()
@@ -131,52 +380,169 @@ class Worker(object):
 
     def _add_poll_handler(self, socket, flags, handler):
         poll_handler = self.PollHandler(socket, flags, handler)
-        self.poll_handlers.append(poll_handler)
+        self.poll_handlers[socket] = poll_handler
+        self.poller.register(socket, flags)
+
+    def _remove_poll_handler(self, socket):
+        del self.poll_handlers[socket]
+        self.poller.unregister(socket)
+
+    def _update_poll_handler(self, socket, flags):
+        """
+        Change the events polled on a socket. The poller is only touched
+        when the flags actually change.
+        """
+        poll_handler = self.poll_handlers[socket]
+        if poll_handler.flags != flags:
+            self.poll_handlers[socket] = poll_handler._replace(flags=flags)
+            self.poller.register(socket, flags)
+
+    def _add_timer(self, delay, callback, interval=None):
+        """
+        Schedule callback to run after delay seconds and then every
+        interval seconds, if given. Returns a handle for _cancel_timer.
+        """
+        timer = [time.monotonic() + delay, next(self.timer_sequence),
+                 interval, callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    @staticmethod
+    def _cancel_timer(timer):
+        # Cancelled timers are dropped lazily when they reach the heap top.
+        timer[3] = None
+
+    def _next_timeout(self):
+        while self.timers and self.timers[0][3] is None:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        delay = self.timers[0][0] - time.monotonic()
+        return max(0, int(math.ceil(delay * 1000)))
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)
+            deadline, sequence, interval, callback = timer
+            if callback is None:
+                continue
+            if interval is not None:
+                timer[0] = max(deadline + interval, now)
+                heapq.heappush(self.timers, timer)
+            callback()
 
     def _before_start(self):
-        self.poll_handlers = []
+        self.poll_handlers = {}
+        self.timers = []
+        self.poller = zmq.Poller()
         self.stop_signal = False
-        self.control_socket = Socket(
+        # Framed like REQ but able to receive while busy: requests sent
+        # ahead by the controller (prefetch) wait in the socket queue and
+        # are served in order.
+        self.control_socket = DealerSocket(
             self.context,
-            zmq.REQ,
-            identity=self.identity
+            zmq.DEALER,
+            identity=self.identity,
+            codec=self.codec
         )
         self._add_poll_handler(
             self.control_socket,
             zmq.POLLIN if not self.stop_signal else 0,
             self._handle_ctrl_socket
         )
+        if self.heartbeat_interval is not None:
+            self.last_controller_message = None
+            self._add_timer(
+                self.heartbeat_interval / 1000.0,
+                self._heartbeat,
+                interval=self.heartbeat_interval / 1000.0
+            )
 
     def _before_stop(self):
         self.control_socket.close()
 
     def _handle_poll(self):
-        for poll_handler in self.poll_handlers:
-            self.poller.register(
-                poll_handler.socket,
-                poll_handler.flags
-            )
-        sockets = dict(self.poller.poll(1))
-        for poll_handler in self.poll_handlers:
+        # Block until a socket is ready or the next timer is due.
+        sockets = dict(self.poller.poll(self._next_timeout()))
+        for poll_handler in list(self.poll_handlers.values()):
             if poll_handler.socket in sockets:
                 poll_handler.handler()
+        self._run_timers()
 
     def _handle_ctrl_socket(self):
-        response = self.control_socket.recv_from_client()
-        self.control_socket.send_to_client(
+        response = self.control_socket.recv_batch_from_client(decode=False)
+        payloads = [frame.bytes for frame in response.message]
+        response.message = [Socket.decode(payload) for payload in payloads]
+        self.last_controller_message = time.monotonic()
+        if response.client == b'$controller' and \
+                response.message == [self.HEARTBEAT]:
+            return
+        # Reply with the codec of the request, not the socket codec: the
+        # client may use values only its codec supports.
+        reply_codec = payload_codec.codec_of(payloads[0])
+        self._handle_ctrl_request(response, reply_codec)
+
+    def _handle_ctrl_request(self, response, reply_codec):
+        if response.expired:
+            # The client has given up waiting: skip the handler.
+            replies = [
+                self.handler_deadline_exceeded(message)
+                for message in response.message
+            ]
+        else:
+            trace_event(response.headers, 'handler_start')
+            if len(response.message) == 1:
+                replies = [self.resolve(response.message[0])]
+            else:
+                replies = self.resolve_batch(response.message)
+            trace_event(response.headers, 'handler_end')
+        self._send_ctrl_replies(response, replies, reply_codec)
+
+    def _send_ctrl_replies(self, response, replies, reply_codec):
+        self.control_socket.send_batch_to_client(
             response.client,
             response.uuid,
-            self.resolve(response.message)
+            [self._encode_reply(reply_codec, reply) for reply in replies],
+            response.headers
         )
 
-    def _signal_ready(self, endpoint):
-        self.control_socket.connect(endpoint)
+    def _encode_reply(self, reply_codec, reply):
+        if isinstance(reply, (bytes, zmq.Frame)):
+            return reply
+        try:
+            return reply_codec.encode(reply)
+        except (TypeError, ValueError):
+            logger.exception("Reply not serializable")
+            return reply_codec.encode(self.UNSERIALIZABLE_REPLY)
+
+    def _heartbeat(self):
+        if self.control_socket.poll(0):
+            # Messages are waiting: the controller is alive, the worker was
+            # just busy.
+            self.last_controller_message = time.monotonic()
+        elif self.last_controller_message is not None and \
+                time.monotonic() - self.last_controller_message > \
+                self.heartbeat_interval * self.heartbeat_liveness / 1000.0:
+            logger.warning(
+                "Worker %s lost its controller: stopping",
+                self.identity.decode('utf8')
+            )
+            self.stop_signal = True
+            return
         self.control_socket.send_to_client(
             b'$controller',
             b'$uuid',
-            {"$signal": "ready"}
+            self.HEARTBEAT
         )
 
+    def _signal_ready(self, endpoint, error=None):
+        message = {"$signal": "ready"}
+        if error is not None:
+            message['$error'] = error
+        self.control_socket.connect(endpoint)
+        self.control_socket.send_to_client(b'$controller', b'$uuid', message)
+
     @staticmethod
     def handler_default(message):
         response = {}
@@ -184,6 +550,13 @@ class Worker(object):
         response.update({"$rep": None, "$error": "No handler match"})
         return response
 
+    @staticmethod
+    def handler_deadline_exceeded(message):
+        response = {}
+        response.update(message)
+        response.update({"$rep": None, "$error": "Deadline exceeded"})
+        return response
+
     def handler_eval(self, message):
         response = {}
         response.update(message)
@@ -191,6 +564,15 @@ class Worker(object):
         response.update({'$rep': attr})
         return response
 
+    def handler_metrics(self, message):
+        response = {}
+        response.update(message)
+        response.update({'$rep': self.get_metrics()})
+        return response
+
+    def get_metrics(self):
+        return self.metrics.snapshot()
+
     def handler_stop(self, message):
         response = {}
         response.update(message)
@@ -201,21 +583,131 @@ class Worker(object):
     def bind_handler(self, message, handler):
         self.message_handlers.append(MessageHandler(message, handler))
         self.message_handlers.sort()
+        self.message_index = MessageHandlerIndex(self.message_handlers)
+
+    def bind_batch_handler(self, message, handler):
+        """
+        Bind a handler that receives a list of matching messages and
+        returns the list of replies, in the same order. Single messages
+        are resolved as a batch of one.
+        """
+        self.bind_handler(message, BatchHandler(handler))
+
+    @property
+    def batch_patterns(self):
+        return [
+            message_handler.message
+            for message_handler in self.message_handlers
+            if isinstance(message_handler.handler, BatchHandler)
+        ]
 
     def unbind_handler(self, message):
         for message_handler in self.message_handlers:
             if message_handler.message == message:
                 self.message_handlers.remove(message_handler)
+                self.message_index = MessageHandlerIndex(
+                    self.message_handlers
+                )
                 return
         raise LookupHandlerError("No handler for {}".format(message))
 
-    def get_handler_for(self, message):
-        for message_handler in self.message_handlers:
-            if message_handler.match_in(message):
-                return message_handler.handler
+    def get_message_handler_for(self, message):
+        message_handler = self.message_index.lookup(message)
+        if message_handler is not None:
+            return message_handler
         raise LookupHandlerError("No handler for {}".format(message))
 
+    def get_handler_for(self, message):
+        return self.get_message_handler_for(message).handler
+
     def resolve(self, message):
-        handler = self.get_handler_for(message)
-        return handler(message)
+        message_handler = self.get_message_handler_for(message)
+        return self._call_handler(message_handler, message)
+
+    def _call_handler(self, message_handler, message, batch=False):
+        # Handler latency and errors are recorded under the handler key.
+        handler = message_handler.handler.handler if batch \
+            else message_handler.handler
+        requests = len(message) if batch else 1
+        start = time.perf_counter()
+        try:
+            response = handler(message)
+        except Exception:
+            self.metrics.observe(
+                message_handler.key,
+                time.perf_counter() - start,
+                errors=requests,
+                requests=requests
+            )
+            raise
+        elapsed = time.perf_counter() - start
+        if batch:
+            errors = sum(1 for reply in response if is_error(reply))
+        else:
+            errors = 1 if is_error(response) else 0
+        self.metrics.observe(
+            message_handler.key,
+            elapsed,
+            errors=errors,
+            requests=requests
+        )
+        return response
+
+    def resolve_batch(self, messages):
+        """
+        Messages that all resolve to the same batch handler are passed to
+        it in a single call; otherwise they are resolved one by one.
+        """
+        message_handlers = [
+            self.get_message_handler_for(message) for message in messages
+        ]
+        message_handler = message_handlers[0]
+        if isinstance(message_handler.handler, BatchHandler) and \
+                all(other is message_handler for other in message_handlers):
+            replies = self._call_handler(message_handler, messages, batch=True)
+            if len(replies) != len(messages):
+                raise ValueError(
+                    "Batch handler returned {} replies for {} "
+                    "messages.".format(len(replies), len(messages))
+                )
+            return replies
+        return [
+            self._call_handler(message_handler, message)
+            for message_handler, message in zip(message_handlers, messages)
+        ]
+
+
+def is_error(reply):
+    return isinstance(reply, dict) and reply.get('$error') is not None
+
+
+class StartupGate(object):
+    """
+    Passed once a worker thread is built, before it connects: a controller
+    giving up on the startup cancels the threads that haven't passed yet.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.passed = False
+        self.cancelled = False
+
+    def enter(self):
+        with self.lock:
+            self.passed = not self.cancelled
+            return self.passed
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = not self.passed
+            return self.cancelled
+
 
+def run_worker(worker_factory, kwargs, endpoint, identity, startup=None):
+    """
+    Entry point of the worker threads and processes.
+    """
+    worker = worker_factory(**kwargs)
+    if startup is not None and not startup.enter():
+        return
+    worker(endpoint=endpoint, identity=identity)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import tempfile
+import time
+import unittest
+
+import zmq
+
+from lucena.broker import create_broker
+from lucena.client import RemoteClient
+from lucena.io2.socket import DealerSocket
+from lucena.service import create_service
+from lucena.worker import Worker
+
+
+class NameWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(NameWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'name'}, NameWorker.handler_name)
+
+    @staticmethod
+    def handler_name(message):
+        return {'$rep': 'name'}
+
+
+def ipc_endpoint():
+    return "ipc://{}.ipc".format(tempfile.NamedTemporaryFile().name)
+
+
+class TestBroker(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBroker, self).setUp()
+        self.endpoint = ipc_endpoint()
+        self.backend_endpoint = ipc_endpoint()
+        self.broker = create_broker(
+            endpoint=self.endpoint,
+            backend_endpoint=self.backend_endpoint,
+            heartbeat_interval=20
+        )
+        self.broker.start()
+        self.services = [
+            create_service(
+                service_name,
+                worker_factory=NameWorker,
+                endpoint=ipc_endpoint(),
+                broker_endpoint=self.backend_endpoint,
+                broker_heartbeat_interval=20
+            )
+            for service_name in ('Echo', 'Echo', 'Other')
+        ]
+        for service in self.services:
+            service.start()
+        self.wait_for_registration({'Echo': 2, 'Other': 1})
+        self.client = RemoteClient(default_timeout=1000)
+        self.client.connect(self.endpoint)
+
+    def tearDown(self):
+        self.client.close()
+        for service in self.services:
+            service.stop()
+        self.broker.stop()
+        super(TestBroker, self).tearDown()
+
+    def wait_for_registration(self, expected):
+        for _ in range(100):
+            response = self.broker.resolve({
+                '$req': 'eval',
+                '$attr': 'registered_services'
+            })
+            if response['$rep'] == expected:
+                return
+            time.sleep(0.01)
+        self.fail('Services not registered: {}'.format(response['$rep']))
+
+    def total_client_requests(self, service):
+        return service.resolve({
+            '$req': 'eval',
+            '$attr': 'total_client_requests'
+        })['$rep']
+
+    def test_route_by_service_name(self):
+        for _ in range(10):
+            self.assertEqual(
+                self.client.resolve({'$req': 'name'}, service_name='Echo'),
+                {'$rep': 'name'}
+            )
+        self.assertEqual(
+            self.client.resolve_many(
+                [{'$req': 'name'}] * 3,
+                service_name='Other'
+            ),
+            [{'$rep': 'name'}] * 3
+        )
+        # Ties are balanced round robin across the instances of a name.
+        self.assertEqual(
+            [self.total_client_requests(s) for s in self.services],
+            [5, 5, 3]
+        )
+
+    def test_unknown_service(self):
+        for service_name in ('Missing', None):
+            response = self.client.resolve(
+                {'$req': 'name'},
+                service_name=service_name
+            )
+            self.assertEqual(response['$error'], 'Unknown service')
+
+    def test_drop_silent_instances(self):
+        # An instance that registers and then never heartbeats, as if it
+        # crashed.
+        socket = DealerSocket(
+            zmq.Context.instance(),
+            zmq.DEALER,
+            identity=b'Echo#crashed'
+        )
+        socket.connect(self.backend_endpoint)
+        socket.send_to_client(
+            b'$broker',
+            b'$uuid',
+            {'$signal': 'register', 'service': 'Echo'}
+        )
+        with self.assertLogs('lucena.broker', level='WARNING'):
+            self.wait_for_registration({'Echo': 3, 'Other': 1})
+            self.wait_for_registration({'Echo': 2, 'Other': 1})
+        socket.close()
+
+    def test_register_again_after_broker_restart(self):
+        self.broker.stop()
+        self.broker.start()
+        with self.assertLogs('lucena.service', level='WARNING'):
+            self.wait_for_registration({'Echo': 2, 'Other': 1})
+        response = self.client.resolve({'$req': 'name'}, service_name='Echo')
+        self.assertEqual(response, {'$rep': 'name'})
+
+    def test_unregister_on_stop(self):
+        self.services[0].stop()
+        self.wait_for_registration({'Echo': 1, 'Other': 1})
+        response = self.client.resolve({'$req': 'name'}, service_name='Echo')
+        self.assertEqual(response, {'$rep': 'name'})
+        self.services[0].start()
+        self.wait_for_registration({'Echo': 2, 'Other': 1})
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+from lucena.cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.cache = ResponseCache(max_entries=2)
+        self.cache.add_pattern({'$req': 'get'})
+
+    def test_key_is_canonical(self):
+        self.assertEqual(
+            self.cache.key_for({'$req': 'get', 'a': 1, 'b': 2}),
+            self.cache.key_for({'b': 2, 'a': 1, '$req': 'get'})
+        )
+
+    def test_only_matching_messages_are_cacheable(self):
+        self.assertIsNone(self.cache.key_for({'$req': 'set'}))
+        self.assertIsNone(self.cache.key_for({'$req': 'get', 'b': b'x'}))
+        self.assertIsNone(self.cache.key_for([1, 2]))
+
+    def test_pattern_ttl(self):
+        self.cache.add_pattern({'$req': 'get', 'fresh': True}, ttl=20)
+        cache_key = self.cache.key_for({'$req': 'get', 'fresh': True})
+        self.assertEqual(cache_key.ttl, 20)
+        self.cache.put(cache_key, b'reply')
+        self.assertEqual(self.cache.get(cache_key), b'reply')
+        time.sleep(0.03)
+        self.assertIsNone(self.cache.get(cache_key))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_add_pattern_again_updates_ttl(self):
+        self.cache.add_pattern({'$req': 'get'}, ttl=50)
+        self.assertEqual(self.cache.patterns, [{'$req': 'get'}])
+        self.assertEqual(self.cache.key_for({'$req': 'get'}).ttl, 50)
+
+    def test_lru_eviction(self):
+        keys = [self.cache.key_for({'$req': 'get', 'n': n}) for n in range(3)]
+        self.cache.put(keys[0], b'0')
+        self.cache.put(keys[1], b'1')
+        self.cache.get(keys[0])
+        self.cache.put(keys[2], b'2')
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertEqual(self.cache.get(keys[0]), b'0')
+        self.assertEqual(self.cache.get(keys[2]), b'2')
+        stats = self.cache.stats()
+        self.assertEqual(
+            (stats['hits'], stats['misses'], stats['evictions']),
+            (3, 1, 1)
+        )
+
+    def test_memory_bound(self):
+        cache = ResponseCache(max_bytes=100)
+        cache.add_pattern({})
+        big_key = cache.key_for({'n': 0})
+        cache.put(big_key, b'x' * 100)
+        self.assertIsNone(cache.get(big_key))
+        for n in range(10):
+            cache.put(cache.key_for({'n': n}), b'x' * 20)
+        self.assertLessEqual(cache.stats()['bytes'], 100)
+        self.assertEqual(cache.stats()['entries'], 3)
+
+    def test_invalid_parameters(self):
+        self.assertRaises(ValueError, ResponseCache, max_entries=0)
+        self.assertRaises(ValueError, ResponseCache, max_bytes='a')
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+import collections
+import tempfile
+import threading
+import time
+import unittest
+
+from lucena.client import ClientPool, HashRing, ResilientClient, \
+    ShardedClient
+from lucena.exceptions import IOTimeout
+from lucena.service import create_service
+from lucena.worker import Worker
+
+
+class SleepWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(SleepWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'sleep'}, SleepWorker.handler_sleep)
+
+    @staticmethod
+    def handler_sleep(message):
+        time.sleep(1)
+        response = {}
+        response.update(message)
+        response.update({'$rep': 'sleep 1 sec'})
+        return response
+
+
+class HangWorker(Worker):
+    release = threading.Event()
+    hangs = 0
+
+    def __init__(self, *args, **kwargs):
+        super(HangWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'hang'}, HangWorker.handler_hang)
+        self.bind_handler({'$req': 'hang-once'}, HangWorker.handler_hang_once)
+
+    @staticmethod
+    def handler_hang(message):
+        HangWorker.release.wait()
+        return {'$rep': 'released'}
+
+    @staticmethod
+    def handler_hang_once(message):
+        HangWorker.hangs += 1
+        if HangWorker.hangs == 1:
+            HangWorker.release.wait()
+        return {'$rep': 'OK'}
+
+
+class QuickWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(QuickWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'sleep'}, QuickWorker.handler_sleep)
+
+    @staticmethod
+    def handler_sleep(message):
+        return {'$rep': 'no sleep'}
+
+
+class TestHashRing(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHashRing, self).setUp()
+        self.keys = ['key-{}'.format(i) for i in range(10000)]
+
+    def assignment(self, ring):
+        return {key: ring.get(key) for key in self.keys}
+
+    def test_keys_are_balanced(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        counts = collections.Counter(self.assignment(ring).values())
+        self.assertEqual(sorted(counts), ['a', 'b', 'c', 'd'])
+        for count in counts.values():
+            self.assertGreater(count, len(self.keys) * 0.15)
+
+    def test_add_node_moves_its_share_of_keys(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        before = self.assignment(ring)
+        ring.add('e')
+        after = self.assignment(ring)
+        moved = [key for key in self.keys if before[key] != after[key]]
+        # Only keys taken over by the new node move: about 1/5.
+        self.assertEqual({after[key] for key in moved}, {'e'})
+        self.assertLess(abs(len(moved) / len(self.keys) - 0.2), 0.1)
+
+    def test_remove_node_only_moves_its_keys(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        before = self.assignment(ring)
+        ring.remove('b')
+        after = self.assignment(ring)
+        for key in self.keys:
+            if before[key] != 'b':
+                self.assertEqual(after[key], before[key])
+        self.assertNotIn('b', after.values())
+
+    def test_remove_unknown_node(self):
+        ring = HashRing(['a', 'b'])
+        ring.remove('c')
+        ring.remove('b')
+        ring.remove('b')
+        self.assertEqual(ring.nodes, ['a'])
+        self.assertEqual(set(self.assignment(ring).values()), {'a'})
+
+    def test_empty_ring(self):
+        ring = HashRing()
+        self.assertRaises(LookupError, ring.get, 'key')
+
+
+class TestShardedClient(unittest.TestCase):
+
+    def setUp(self):
+        super(TestShardedClient, self).setUp()
+        self.endpoints = [
+            "ipc://{}.ipc".format(tempfile.NamedTemporaryFile().name)
+            for _ in range(3)
+        ]
+        self.services = [
+            create_service('MyService', endpoint=endpoint)
+            for endpoint in self.endpoints
+        ]
+        for service in self.services:
+            service.start()
+        self.client = ShardedClient(
+            self.endpoints,
+            shard_key=lambda message: message['id'],
+            default_timeout=1000
+        )
+
+    def tearDown(self):
+        self.client.close()
+        for service in self.services:
+            service.stop()
+        super(TestShardedClient, self).tearDown()
+
+    def total_client_requests(self):
+        return [
+            service.resolve({
+                '$req': 'eval',
+                '$attr': 'total_client_requests'
+            })['$rep']
+            for service in self.services
+        ]
+
+    def test_resolve_many_across_shards(self):
+        messages = [{'$req': 'HELLO', 'id': i} for i in range(30)]
+        replies = self.client.resolve_many(messages)
+        self.assertEqual([reply['id'] for reply in replies], list(range(30)))
+        expected = collections.Counter(
+            self.client.endpoint_for(message) for message in messages
+        )
+        self.assertEqual(
+            self.total_client_requests(),
+            [expected[endpoint] for endpoint in self.endpoints]
+        )
+        # One connection per shard.
+        self.assertEqual(self.client.pool.stats()['clients'], 3)
+
+    def test_resolve_routes_by_shard_key(self):
+        message = {'$req': 'HELLO', 'id': 7}
+        for _ in range(3):
+            self.assertEqual(self.client.resolve(message)['id'], 7)
+        index = self.endpoints.index(self.client.endpoint_for(message))
+        counts = [0, 0, 0]
+        counts[index] = 3
+        self.assertEqual(self.total_client_requests(), counts)
+
+    def test_remove_endpoint_closes_its_clients(self):
+        messages = [{'$req': 'HELLO', 'id': i} for i in range(30)]
+        self.client.resolve_many(messages)
+        endpoint = self.endpoints[0]
+        self.client.remove_endpoint(endpoint)
+        stats = self.client.pool.stats()
+        self.assertEqual((stats['clients'], stats['idle_clients']), (2, 2))
+        replies = self.client.resolve_many(messages)
+        self.assertEqual([reply['id'] for reply in replies], list(range(30)))
+        self.assertNotIn(
+            endpoint,
+            [self.client.endpoint_for(message) for message in messages]
+        )
+
+
+class TestClientPool(unittest.TestCase):
+    def setUp(self):
+        super(TestClientPool, self).setUp()
+        self.endpoint = "ipc://{}.ipc".format(
+            tempfile.NamedTemporaryFile().name
+        )
+        self.service = create_service(
+            'MyService',
+            worker_factory=SleepWorker,
+            number_of_workers=4,
+            endpoint=self.endpoint
+        )
+
+    def test_client_pool_reuses_clients(self):
+        self.service.start()
+        pool = ClientPool(max_size=2, default_timeout=500)
+        for i in range(5):
+            response = pool.resolve(self.endpoint, {"$req": "HELLO"})
+            self.assertEqual(response['$req'], 'HELLO')
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (4, 1))
+        pool.close()
+        self.service.stop()
+
+    def test_client_pool_resets_timed_out_clients(self):
+        self.service.start()
+        pool = ClientPool(max_size=1, default_timeout=200)
+        with self.assertRaises(IOTimeout):
+            pool.resolve(self.endpoint, {"$req": "sleep"})
+        response = pool.resolve(self.endpoint, {"$req": "HELLO"})
+        self.assertEqual(response['$req'], 'HELLO')
+        self.assertEqual(pool.stats()['resets'], 1)
+        self.assertEqual(pool.stats()['clients'], 1)
+        pool.close()
+        self.service.stop()
+
+    def test_client_pool_checkout_timeout(self):
+        pool = ClientPool(max_size=1)
+        client = pool.checkout(self.endpoint)
+        self.assertRaises(IOTimeout, pool.checkout, self.endpoint, 50)
+        pool.checkin(client)
+        self.assertIs(pool.checkout(self.endpoint, 50), client)
+        pool.checkin(client)
+        pool.close()
+
+    def test_client_pool_keeps_clients_on_caller_errors(self):
+        pool = ClientPool(max_size=1)
+        with self.assertRaises(KeyError):
+            with pool.connection(self.endpoint) as client:
+                raise KeyError()
+        self.assertEqual(pool.stats()['resets'], 0)
+        self.assertIs(pool.checkout(self.endpoint), client)
+        pool.checkin(client)
+        pool.close()
+
+    def test_client_pool_closes_clients_checked_in_after_close(self):
+        pool = ClientPool(max_size=1)
+        client = pool.checkout(self.endpoint)
+        pool.close()
+        pool.checkin(client)
+        self.assertTrue(client.socket.closed)
+        self.assertEqual(pool.stats()['idle_clients'], 0)
+
+    def test_client_pool_discard(self):
+        pool = ClientPool(max_size=2)
+        idle = pool.checkout(self.endpoint)
+        busy = pool.checkout(self.endpoint)
+        pool.checkin(idle)
+        pool.discard(self.endpoint)
+        self.assertTrue(idle.socket.closed)
+        self.assertFalse(busy.socket.closed)
+        self.assertEqual(pool.stats()['clients'], 1)
+        # The client checked out on discard is closed when returned.
+        pool.checkin(busy)
+        self.assertEqual(
+            (pool.stats()['clients'], pool.stats()['idle_clients']),
+            (0, 0)
+        )
+        pool.close()
+
+
+class TestResilientClient(unittest.TestCase):
+    def setUp(self):
+        super(TestResilientClient, self).setUp()
+        self.endpoint = "ipc://{}.ipc".format(
+            tempfile.NamedTemporaryFile().name
+        )
+        self.service = create_service(
+            'MyService',
+            worker_factory=HangWorker,
+            number_of_workers=2,
+            endpoint=self.endpoint
+        )
+        HangWorker.release.clear()
+        HangWorker.hangs = 0
+        self.service.start()
+
+    def tearDown(self):
+        HangWorker.release.set()
+        self.service.stop()
+        super(TestResilientClient, self).tearDown()
+
+    def test_retry_idempotent_requests(self):
+        client = ResilientClient(
+            default_timeout=100,
+            idempotent_patterns=[{'$req': 'hang-once'}],
+            backoff=10
+        )
+        client.connect(self.endpoint)
+        self.assertEqual(client.resolve({'$req': 'hang-once'}), {'$rep': 'OK'})
+        stats = client.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['retries'], 1)
+        client.close()
+
+    def test_timeout_leaves_client_usable(self):
+        client = ResilientClient(
+            default_timeout=100,
+            idempotent_patterns=[{'$req': 'hang-once'}]
+        )
+        client.connect(self.endpoint)
+        self.assertRaises(IOTimeout, client.resolve, {'$req': 'hang'})
+        self.assertEqual(client.stats()['retries'], 0)
+        response = client.resolve({'$req': 'HELLO'})
+        self.assertEqual(response['$error'], 'No handler match')
+        client.close()
+
+    def test_hedge_to_another_endpoint(self):
+        slow_endpoint = "ipc://{}.ipc".format(
+            tempfile.NamedTemporaryFile().name
+        )
+        slow_service = create_service(
+            'MyService',
+            worker_factory=SleepWorker,
+            endpoint=slow_endpoint
+        )
+        quick_endpoint = "ipc://{}.ipc".format(
+            tempfile.NamedTemporaryFile().name
+        )
+        quick_service = create_service(
+            'MyService',
+            worker_factory=QuickWorker,
+            endpoint=quick_endpoint
+        )
+        slow_service.start()
+        quick_service.start()
+        client = ResilientClient(
+            default_timeout=5000,
+            idempotent_patterns=[{'$req': 'sleep'}],
+            hedge=True,
+            hedge_delay=20
+        )
+        client.connect(slow_endpoint)
+        client.connect(quick_endpoint)
+        start = time.monotonic()
+        self.assertEqual(
+            client.resolve({'$req': 'sleep'}),
+            {'$rep': 'no sleep'}
+        )
+        self.assertLess(time.monotonic() - start, 0.5)
+        stats = client.stats()
+        self.assertEqual(stats['hedges'], 1)
+        self.assertEqual(stats['hedge_wins'], 1)
+        client.close()
+        slow_service.stop()
+        quick_service.stop()
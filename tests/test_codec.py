@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from lucena.io2 import codec
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCodec, self).setUp()
+        self.message = {
+            '$req': 'hello',
+            'none': None,
+            'flags': [True, False],
+            'int': -123,
+            'bigint': 2 ** 80,
+            'float': 1.5,
+            'unicode': 'cañón',
+            'nested': {'a': [1, {'b': []}], 'c': {}},
+        }
+
+    def test_json_roundtrip(self):
+        data = codec.json_codec.encode(self.message)
+        self.assertEqual(codec.decode(data), self.message)
+
+    def test_binary_roundtrip(self):
+        data = codec.binary_codec.encode(self.message)
+        self.assertTrue(data.startswith(codec.BinaryCodec.MAGIC))
+        self.assertEqual(codec.decode(data), self.message)
+
+    def test_binary_keeps_bytes_and_tuples_as_lists(self):
+        data = codec.binary_codec.encode({'raw': b'\x00\xff', 't': (1, 2)})
+        self.assertEqual(codec.decode(data), {'raw': b'\x00\xff', 't': [1, 2]})
+
+    def test_binary_rejects_unknown_types(self):
+        self.assertRaises(TypeError, codec.binary_codec.encode, object())
+
+    def test_binary_rejects_malformed_payloads(self):
+        data = codec.binary_codec.encode({'a': 'hello'})
+        self.assertRaises(ValueError, codec.binary_codec.decode, data + b'N')
+        self.assertRaises(ValueError, codec.binary_codec.decode, data[:-2])
+        self.assertRaises(ValueError, codec.binary_codec.decode, b'{}')
+        # A list as a dict key.
+        data = codec.BinaryCodec.MAGIC + b'm\x01\x00\x00\x00l\x00\x00\x00\x00N'
+        self.assertRaises(ValueError, codec.binary_codec.decode, data)
+        # Nested deeper than the recursion limit.
+        data = codec.BinaryCodec.MAGIC + b'l\x01\x00\x00\x00' * 100000
+        self.assertRaises(ValueError, codec.binary_codec.decode, data + b'N')
+
+    def test_codec_of(self):
+        self.assertIs(
+            codec.codec_of(codec.binary_codec.encode(self.message)),
+            codec.binary_codec
+        )
+        self.assertIs(
+            codec.codec_of(codec.json_codec.encode(self.message)),
+            codec.json_codec
+        )
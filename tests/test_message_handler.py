@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import unittest
 
-from lucena.message_handler import MessageHandler
+from lucena.message_handler import MessageHandler, MessageHandlerIndex, \
+    pattern_index
 
 
 class TestMessageHandler(unittest.TestCase):
@@ -30,3 +31,58 @@ class TestMessageHandler(unittest.TestCase):
             None
         )
         self.assertTrue(mh1 < mh2)
+
+
+class TestMessageHandlerIndex(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMessageHandlerIndex, self).setUp()
+        self.message_handlers = sorted([
+            MessageHandler({}, 'default'),
+            MessageHandler({'a': 1}, 'a1'),
+            MessageHandler({'a': 1, 'b': 2}, 'a1b2'),
+            MessageHandler({'a': 1, 'c': 3}, 'a1c3'),
+            MessageHandler({'a': 2, 'b': 2}, 'a2b2'),
+            MessageHandler({'a': [1, 2]}, 'a12'),
+        ])
+        self.index = MessageHandlerIndex(self.message_handlers)
+
+    def linear_lookup(self, message):
+        for message_handler in self.message_handlers:
+            if message_handler.match_in(message):
+                return message_handler
+
+    def test_lookup_matches_linear_scan(self):
+        messages = [
+            {},
+            {'a': 1},
+            {'a': 1, 'b': 2},
+            {'a': 1, 'b': 2, 'c': 3},
+            {'a': 2, 'b': 2, 'c': 3},
+            {'a': 2},
+            {'a': [1, 2], 'b': 2},
+            {'a': {'x': 1}},
+            {'z': 0},
+        ]
+        for message in messages:
+            self.assertIs(
+                self.index.lookup(message),
+                self.linear_lookup(message)
+            )
+
+    def test_alphabetical_order_win(self):
+        self.assertEqual(
+            self.index.lookup({'a': 1, 'b': 2, 'c': 3}).handler,
+            'a1b2'
+        )
+
+    def test_lookup_without_match_returns_none(self):
+        index = MessageHandlerIndex([MessageHandler({'a': 1}, None)])
+        self.assertIsNone(index.lookup({'a': 2}))
+
+    def test_pattern_index(self):
+        index = pattern_index([{'a': 1}, {'a': 1, 'b': 2}])
+        self.assertEqual(index.lookup({'a': 1, 'b': 2}).message,
+                         {'a': 1, 'b': 2})
+        self.assertEqual(index.lookup({'a': 1}).message, {'a': 1})
+        self.assertIsNone(index.lookup({'b': 2}))
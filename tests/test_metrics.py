@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from lucena.metrics import Histogram, WorkerMetrics, merge_handlers
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram(bounds=(1, 10, 100))
+        for value in (0.5, 5, 5, 50, 500):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.total, 560.5)
+        self.assertEqual(histogram.max, 500)
+
+    def test_merge(self):
+        histogram = Histogram(bounds=(1, 10, 100))
+        other = Histogram(bounds=(1, 10, 100))
+        for value in (0.5, 5):
+            histogram.observe(value)
+        for value in (5, 500):
+            other.observe(value)
+        histogram.merge(other.snapshot())
+        self.assertEqual(histogram.counts, [1, 2, 0, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.total, 510.5)
+        self.assertEqual(histogram.max, 500)
+        self.assertRaises(
+            ValueError,
+            histogram.merge,
+            Histogram(bounds=(1, 10)).snapshot()
+        )
+
+    def test_percentile(self):
+        histogram = Histogram(bounds=(1, 10, 100))
+        self.assertIsNone(histogram.percentile(50))
+        for value in range(1, 101):
+            histogram.observe(value * 0.1)
+        self.assertEqual(histogram.percentile(5), 1)
+        self.assertEqual(histogram.percentile(50), 10)
+        self.assertEqual(histogram.percentile(100), 10)
+        histogram.observe(1000)
+        self.assertEqual(histogram.percentile(100), 1000)
+
+
+class TestWorkerMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        metrics = WorkerMetrics()
+        metrics.observe('{"$req": "a"}', 0.002)
+        metrics.observe('{"$req": "a"}', 0.004, errors=1)
+        metrics.observe('{"$req": "b"}', 0.001, requests=3)
+        snapshot = metrics.snapshot()
+        handler_a = snapshot['handlers']['{"$req": "a"}']
+        self.assertEqual((handler_a['requests'], handler_a['errors']), (2, 1))
+        self.assertEqual(handler_a['latency']['count'], 2)
+        self.assertAlmostEqual(handler_a['latency']['max'], 4)
+        self.assertEqual(snapshot['handlers']['{"$req": "b"}']['requests'], 3)
+        self.assertAlmostEqual(snapshot['busy_time'], 0.007)
+
+    def test_merge_handlers(self):
+        snapshots = []
+        for elapsed in (0.002, 0.004):
+            metrics = WorkerMetrics()
+            metrics.observe('{"$req": "a"}', elapsed, errors=1)
+            snapshots.append(metrics.snapshot())
+        metrics.observe('{"$req": "b"}', 0.001)
+        snapshots.append(metrics.snapshot())
+        handlers = merge_handlers(snapshots)
+        self.assertEqual(handlers['{"$req": "a"}']['requests'], 3)
+        self.assertEqual(handlers['{"$req": "a"}']['errors'], 3)
+        self.assertAlmostEqual(handlers['{"$req": "a"}']['latency']['max'], 4)
+        self.assertEqual(handlers['{"$req": "b"}']['requests'], 1)
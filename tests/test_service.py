@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import tempfile
 import time
 import threading
 import unittest
 from unittest.mock import MagicMock, patch
 
-from lucena.client import RemoteClient
+import zmq
+
+from lucena.cache import ResponseCache
+from lucena.client import AsyncRemoteClient, RemoteClient
 from lucena.exceptions import ServiceAlreadyStarted, ServiceNotStarted, \
-    IOTimeout
+    IOTimeout, WorkerStartupTimeout
 from lucena.service import Service, create_service
-from lucena.io2.socket import Response
+from lucena.tracing import MemorySink, Tracer
+from lucena.io2.codec import binary_codec
+from lucena.io2.socket import Response, Socket
 from lucena.worker import Worker
 
 
@@ -27,6 +33,81 @@ class MyWorker(Worker):
         return response
 
 
+class MyBatchWorker(Worker):
+    batch_sizes = []
+
+    def __init__(self, *args, **kwargs):
+        super(MyBatchWorker, self).__init__(*args, **kwargs)
+        self.bind_batch_handler(
+            {'$req': 'square'},
+            MyBatchWorker.handler_square
+        )
+
+    @staticmethod
+    def handler_square(messages):
+        MyBatchWorker.batch_sizes.append(len(messages))
+        return [{'$rep': message['n'] ** 2} for message in messages]
+
+
+class CountWorker(Worker):
+    calls = 0
+
+    def __init__(self, *args, **kwargs):
+        super(CountWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'count'}, CountWorker.handler_count)
+        self.bind_handler({'$req': 'slow-count'}, CountWorker.handler_count)
+
+    @staticmethod
+    def handler_count(message):
+        CountWorker.calls += 1
+        response = {'$rep': CountWorker.calls}
+        time.sleep(message.get('delay', 0))
+        return response
+
+
+class UnevenStartWorker(Worker):
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        super(UnevenStartWorker, self).__init__(*args, **kwargs)
+        UnevenStartWorker.instances += 1
+        if UnevenStartWorker.instances == 1:
+            time.sleep(0.3)
+
+
+class DyingWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(DyingWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'die'}, self.handler_die)
+
+    def handler_die(self, message):
+        # The worker thread ends after this reply.
+        self.stop_signal = True
+        return {'$rep': 'dying'}
+
+
+class HangWorker(Worker):
+    release = threading.Event()
+    hangs = 0
+
+    def __init__(self, *args, **kwargs):
+        super(HangWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'hang'}, HangWorker.handler_hang)
+        self.bind_handler({'$req': 'hang-once'}, HangWorker.handler_hang_once)
+
+    @staticmethod
+    def handler_hang(message):
+        HangWorker.release.wait()
+        return {'$rep': 'released'}
+
+    @staticmethod
+    def handler_hang_once(message):
+        HangWorker.hangs += 1
+        if HangWorker.hangs == 1:
+            HangWorker.release.wait()
+        return {'$rep': 'OK'}
+
+
 class TestClientService(unittest.TestCase):
     def setUp(self):
         super(TestClientService, self).setUp()
@@ -63,6 +144,149 @@ class TestClientService(unittest.TestCase):
         self.assertEqual(client_requests, response.get('$rep'))
         self.service.stop()
 
+    def test_resolve_many(self):
+        self.service.start()
+        client = RemoteClient(default_timeout=2000)
+        client.connect(self.endpoint)
+        messages = [{"$req": "HELLO", "n": i} for i in range(50)]
+        responses = client.resolve_many(messages)
+        self.assertEqual([r['n'] for r in responses], list(range(50)))
+        self.assertEqual(client.resolve_many([]), [])
+        self.assertEqual(client.resolve_many(messages[:1])[0]['n'], 0)
+        client.close()
+        response = self.service.resolve({
+            '$req': 'eval',
+            '$attr': 'total_client_requests'
+        })
+        self.assertEqual(response.get('$rep'), 51)
+        self.service.stop()
+
+    def test_response_cache(self):
+        endpoint = "ipc://{}.ipc".format(tempfile.NamedTemporaryFile().name)
+        cache = ResponseCache()
+        cache.add_pattern({'$req': 'count'})
+        cache.add_pattern({'$req': 'missing'})
+        service = create_service(
+            'MyService',
+            worker_factory=CountWorker,
+            endpoint=endpoint,
+            response_cache=cache
+        )
+        service.start()
+        CountWorker.calls = 0
+        client = RemoteClient(default_timeout=500)
+        client.connect(endpoint)
+        for _ in range(3):
+            self.assertEqual(client.resolve({'$req': 'count'}), {'$rep': 1})
+        self.assertEqual(
+            client.resolve_many([{'$req': 'count'}] * 2),
+            [{'$rep': 1}] * 2
+        )
+        # Error replies are not cached.
+        for _ in range(2):
+            client.resolve({'$req': 'missing'})
+        client.close()
+        stats = service.resolve({'$req': 'eval', '$attr': 'cache_stats'})
+        self.assertEqual(CountWorker.calls, 1)
+        self.assertEqual(
+            (stats['$rep']['hits'], stats['$rep']['misses']),
+            (4, 3)
+        )
+        service.stop()
+
+    def test_metrics(self):
+        self.service.start()
+        client = RemoteClient(default_timeout=500)
+        client.connect(self.endpoint)
+        client.resolve_many([{"$req": "HELLO"}] * 10)
+        # Served by a worker: its own handler metrics.
+        response = client.resolve({"$req": "metrics"})
+        client.close()
+        self.assertIn('{}', response['$rep']['handlers'])
+        metrics = self.service.metrics()
+        # Handler metrics of all the workers, added up.
+        self.assertEqual(metrics['handlers']['{}']['requests'], 10)
+        self.assertEqual(metrics['handlers']['{}']['latency']['count'], 10)
+        self.assertEqual(
+            metrics['handlers']['{"$req": "metrics"}']['requests'],
+            1
+        )
+        self.assertEqual(metrics['client_requests'], 11)
+        self.assertEqual(metrics['dispatch_latency']['count'], 11)
+        self.assertEqual(
+            sum(w['requests'] for w in metrics['workers'].values()),
+            11
+        )
+        self.service.stop()
+
+    def test_tracing(self):
+        self.service.start()
+        sink = MemorySink()
+        client = RemoteClient(default_timeout=500, tracer=Tracer(sink))
+        client.connect(self.endpoint)
+        client.resolve({"$req": "HELLO"})
+        client.resolve_many([{"$req": "HELLO"}] * 2)
+        client.close()
+        self.service.stop()
+        self.assertEqual(len(sink.traces), 2)
+        for trace in sink.traces:
+            timestamps = [trace[event] for event in Tracer.EVENTS]
+            self.assertEqual(timestamps, sorted(timestamps))
+            self.assertEqual(len(trace['durations']), len(Tracer.EVENTS) - 1)
+
+    def test_binary_codec_client(self):
+        self.service.start()
+        client = RemoteClient(default_timeout=500, codec=binary_codec)
+        client.connect(self.endpoint)
+        response = client.resolve({"$req": "HELLO"})
+        self.assertEqual(
+            response,
+            {"$req": "HELLO", "$rep": None, "$error": "No handler match"}
+        )
+        # The JSON service replies with the codec of the request.
+        response = client.resolve({"a": b'\x00\x01'})
+        self.assertEqual(response['a'], b'\x00\x01')
+        client.close()
+        # The workers are still serving.
+        response = self.client_task({"$req": "HELLO"})
+        self.assertEqual(response['$error'], 'No handler match')
+        self.service.stop()
+
+    def test_burst_larger_than_pool(self):
+        self.service.start()
+        responses = []
+        clients = [
+            threading.Thread(
+                target=lambda: responses.append(
+                    self.client_task({"$req": "HELLO"})
+                )
+            )
+            for _ in range(16)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.assertEqual(len(responses), 16)
+        self.service.stop()
+
+    def test_process_workers(self):
+        endpoint = "ipc://{}.ipc".format(tempfile.NamedTemporaryFile().name)
+        service = create_service(
+            'MyService',
+            worker_factory=MyWorker,
+            number_of_workers=2,
+            endpoint=endpoint,
+            worker_mode='process'
+        )
+        service.start()
+        client = RemoteClient(default_timeout=5000)
+        client.connect(endpoint)
+        response = client.resolve({"$req": "HELLO"})
+        client.close()
+        service.stop()
+        self.assertEqual(response['$error'], 'No handler match')
+
     def test_service_restart(self):
         for i in range(10):
             self.service.start()
@@ -84,6 +308,422 @@ class TestClientService(unittest.TestCase):
         self.service.stop()
 
 
+class TestAsyncClientService(unittest.TestCase):
+    def setUp(self):
+        super(TestAsyncClientService, self).setUp()
+        self.endpoint = "ipc://{}.ipc".format(
+            tempfile.NamedTemporaryFile().name
+        )
+        self.service = create_service(
+            'MyService',
+            worker_factory=MyWorker,
+            number_of_workers=4,
+            endpoint=self.endpoint
+        )
+        self.service.start()
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncRemoteClient(default_timeout=5000)
+        self.client.connect(self.endpoint)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+        self.service.stop()
+        super(TestAsyncClientService, self).tearDown()
+
+    def test_concurrent_requests(self):
+        messages = [{"$req": "HELLO", "n": i} for i in range(200)]
+
+        async def resolve_all():
+            return await asyncio.gather(
+                *[self.client.resolve(message) for message in messages]
+            )
+
+        responses = self.loop.run_until_complete(resolve_all())
+        self.assertEqual([r['n'] for r in responses], list(range(200)))
+        self.assertEqual(self.client.pending_requests, {})
+
+    def test_req_timeout(self):
+        with self.assertRaises(IOTimeout):
+            self.loop.run_until_complete(
+                self.client.resolve({"$req": "sleep"}, timeout=100)
+            )
+        response = self.loop.run_until_complete(
+            self.client.resolve({"$req": "HELLO"})
+        )
+        self.assertEqual(response['$req'], 'HELLO')
+
+    def test_malformed_reply_fails_pending_requests(self):
+        endpoint = Socket.inproc_unique_endpoint()
+        server = Socket(zmq.Context.instance(), zmq.ROUTER)
+        server.bind(endpoint)
+        client = AsyncRemoteClient(default_timeout=5000)
+        client.connect(endpoint)
+
+        async def reply(valid):
+            await asyncio.sleep(0.01)
+            # [client, '', uuid, headers, '', payload]
+            request = server.recv_multipart()
+            if valid:
+                server.send_multipart(request[:3] + [b'', b'{"$rep": 1}'])
+            else:
+                server.send_multipart([request[0], b'garbage'])
+
+        async def resolve(valid):
+            results = await asyncio.gather(
+                client.resolve({'$req': 'HELLO'}),
+                reply(valid),
+                return_exceptions=True
+            )
+            return results[0]
+
+        start = time.monotonic()
+        response = self.loop.run_until_complete(resolve(False))
+        self.assertIsInstance(response, AssertionError)
+        self.assertLess(time.monotonic() - start, 1)
+        # A new receive task serves the next request.
+        response = self.loop.run_until_complete(resolve(True))
+        self.assertEqual(response, {'$rep': 1})
+        client.close()
+        server.close()
+
+    def test_expired_requests_are_not_dispatched(self):
+
+        async def resolve_all():
+            # Keep the other workers busy so the HELLO request waits.
+            for _ in range(3):
+                await self.client.socket.send_multipart([
+                    b'', b'$uuid', b'', b'{"$req": "sleep"}'
+                ])
+            return await asyncio.gather(
+                self.client.resolve({'$req': 'sleep'}),
+                self.client.resolve({'$req': 'HELLO'}, timeout=200),
+                return_exceptions=True
+            )
+
+        responses = self.loop.run_until_complete(resolve_all())
+        self.assertEqual(responses[0]['$rep'], 'sleep 1 sec')
+        self.assertIsInstance(responses[1], IOTimeout)
+        # The request expires when the next worker frees up, which can be
+        # after the client got its own reply.
+        for _ in range(100):
+            response = self.service.resolve({
+                '$req': 'eval',
+                '$attr': 'total_expired_requests'
+            })
+            if response['$rep']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(response['$rep'], 1)
+
+
+class TestServiceOptions(unittest.TestCase):
+    """
+    Every test starts its own service, with the options under test, on a
+    fresh endpoint.
+    """
+    def setUp(self):
+        super(TestServiceOptions, self).setUp()
+        self.endpoint = "ipc://{}.ipc".format(
+            tempfile.NamedTemporaryFile().name
+        )
+        self.service = None
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncRemoteClient(default_timeout=10000)
+        self.client.connect(self.endpoint)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+        if self.service is not None and self.service.is_started():
+            self.service.stop()
+        super(TestServiceOptions, self).tearDown()
+
+    def start_service(self, worker_factory, **kwargs):
+        self.service = create_service(
+            'MyService',
+            worker_factory=worker_factory,
+            endpoint=self.endpoint,
+            **kwargs
+        )
+        self.service.start()
+
+    def eval_attr(self, attr):
+        return self.service.resolve({'$req': 'eval', '$attr': attr})['$rep']
+
+    def resolve_all(self, messages):
+
+        async def resolve_all():
+            return await asyncio.gather(
+                *[self.client.resolve(message) for message in messages]
+            )
+
+        return self.loop.run_until_complete(resolve_all())
+
+    def test_micro_batching(self):
+        self.start_service(
+            MyBatchWorker,
+            number_of_workers=1,
+            batch_size=20,
+            batch_delay=50
+        )
+        MyBatchWorker.batch_sizes = []
+        responses = self.resolve_all(
+            [{'$req': 'square', 'n': n} for n in range(20)]
+        )
+        self.assertEqual(
+            [r['$rep'] for r in responses],
+            [n ** 2 for n in range(20)]
+        )
+        self.assertEqual(sum(MyBatchWorker.batch_sizes), 20)
+        self.assertGreater(max(MyBatchWorker.batch_sizes), 1)
+        # Unmatched messages are not held back.
+        response = self.resolve_all([{'$req': 'HELLO'}])[0]
+        self.assertEqual(response['$error'], 'No handler match')
+
+    def test_micro_batch_tracing(self):
+        self.start_service(
+            MyBatchWorker,
+            number_of_workers=1,
+            batch_size=4,
+            batch_delay=50
+        )
+        sink = MemorySink()
+        client = RemoteClient(default_timeout=5000, tracer=Tracer(sink))
+        client.connect(self.endpoint)
+        MyBatchWorker.batch_sizes = []
+        client.resolve_many([{'$req': 'square', 'n': n} for n in range(4)])
+        client.close()
+        self.service.stop()
+        self.assertEqual(MyBatchWorker.batch_sizes, [4])
+        trace = sink.traces[0]
+        timestamps = [trace[event] for event in Tracer.EVENTS]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_busy_reply_when_queue_is_full(self):
+        self.start_service(
+            MyWorker,
+            number_of_workers=1,
+            max_pending_requests=1
+        )
+        responses = self.resolve_all(
+            [{'$req': 'sleep', 'n': n} for n in range(3)]
+        )
+        self.assertEqual(
+            [r.get('$error') for r in responses],
+            [None, None, 'Service busy']
+        )
+        for attr, value in (('queue_depth', 0), ('max_queue_depth', 1),
+                            ('total_busy_replies', 1)):
+            self.assertEqual(self.eval_attr(attr), value)
+
+    def test_no_busy_reply_with_free_credits(self):
+        self.start_service(
+            CountWorker,
+            number_of_workers=3,
+            max_pending_requests=1
+        )
+        client = RemoteClient(default_timeout=5000)
+        client.connect(self.endpoint)
+        # Every request of the batch gets a worker, none is queued.
+        responses = client.resolve_many([{'$req': 'count'}] * 3)
+        client.close()
+        self.assertEqual([r.get('$error') for r in responses], [None] * 3)
+        self.assertEqual(self.eval_attr('total_busy_replies'), 0)
+
+    def test_autoscaling(self):
+        self.start_service(
+            MyWorker,
+            number_of_workers=1,
+            min_workers=1,
+            max_workers=4,
+            scale_interval=50
+        )
+        responses = self.resolve_all(
+            [{'$req': 'sleep', 'n': n} for n in range(8)]
+        )
+        self.assertEqual(len(responses), 8)
+        self.assertGreater(self.eval_attr('number_of_workers'), 1)
+        # Idle workers are retired down to min_workers.
+        for _ in range(100):
+            if self.eval_attr('number_of_workers') == 1:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.eval_attr('number_of_workers'), 1)
+        response = self.resolve_all([{'$req': 'HELLO'}])[0]
+        self.assertEqual(response['$error'], 'No handler match')
+
+    def test_prefetch(self):
+        self.start_service(CountWorker, number_of_workers=2, prefetch=3)
+        self.assertEqual(self.eval_attr('available_credits'), 6)
+        CountWorker.calls = 0
+        responses = self.resolve_all([{'$req': 'count'} for _ in range(100)])
+        self.assertEqual(
+            sorted(response['$rep'] for response in responses),
+            list(range(1, 101))
+        )
+        self.assertEqual(self.eval_attr('available_credits'), 6)
+        self.assertEqual(self.eval_attr('pending_workers'), False)
+        # Prefetched requests are answered before the workers stop.
+        tasks = [
+            self.loop.create_task(
+                self.client.resolve({'$req': 'slow-count', 'delay': 0.05})
+            )
+            for _ in range(6)
+        ]
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.service.stop()
+        responses = self.loop.run_until_complete(asyncio.gather(*tasks))
+        self.assertEqual(len(responses), 6)
+
+    def test_dead_workers_are_replaced(self):
+        self.start_service(
+            HangWorker,
+            number_of_workers=2,
+            heartbeat_interval=20,
+            idempotent_patterns=[{'$req': 'hang-once'}]
+        )
+        HangWorker.release.clear()
+        HangWorker.hangs = 0
+        with self.assertLogs('lucena.service', level='WARNING'):
+            responses = self.resolve_all(
+                [{'$req': 'hang'}, {'$req': 'hang-once'}]
+            )
+        # The hung request is not idempotent; the other one is dispatched
+        # again to a replacement worker.
+        self.assertEqual(
+            responses,
+            [Service.WORKER_DIED_REPLY, {'$rep': 'OK'}]
+        )
+        self.assertEqual(self.eval_attr('total_dead_workers'), 2)
+        for _ in range(100):
+            if self.eval_attr('available_credits') == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.eval_attr('available_credits'), 2)
+        HangWorker.release.set()
+
+    def test_redeliveries_are_bounded(self):
+        # The handler outlives the liveness window: every worker running
+        # it is declared dead.
+        self.start_service(
+            CountWorker,
+            heartbeat_interval=20,
+            idempotent_patterns=[{'$req': 'slow-count'}],
+            max_redeliveries=1
+        )
+        with self.assertLogs('lucena.service', level='WARNING') as logs:
+            response = self.resolve_all(
+                [{'$req': 'slow-count', 'delay': 0.3}]
+            )[0]
+        self.assertEqual(response, Service.WORKER_DIED_REPLY)
+        self.assertEqual(self.eval_attr('total_dead_workers'), 2)
+        self.assertTrue(any(
+            'Discarded worker threads still running' in line
+            for line in logs.output
+        ))
+        self.assertGreater(
+            self.service.metrics()['abandoned_workers'], 0
+        )
+        # The discarded threads stop once their handler returns.
+        for _ in range(100):
+            if not self.service.metrics()['abandoned_workers']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.service.metrics()['abandoned_workers'], 0)
+
+    def test_stop_with_dead_worker(self):
+        self.start_service(DyingWorker, number_of_workers=2)
+        client = RemoteClient(default_timeout=1000)
+        client.connect(self.endpoint)
+        self.assertEqual(client.resolve({'$req': 'die'}), {'$rep': 'dying'})
+        client.close()
+        start = time.monotonic()
+        self.service.stop()
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_stop_timeout_with_hung_worker(self):
+        self.start_service(HangWorker, stop_timeout=100)
+        HangWorker.release.clear()
+        client = RemoteClient(default_timeout=100)
+        client.connect(self.endpoint)
+        self.assertRaises(IOTimeout, client.resolve, {'$req': 'hang'})
+        client.close()
+        start = time.monotonic()
+        with self.assertLogs('lucena.worker', level='WARNING'):
+            self.service.stop()
+        self.assertLess(time.monotonic() - start, 1)
+        # The late worker stops once its handler returns.
+        HangWorker.release.set()
+
+    def test_heartbeats_with_uneven_worker_start(self):
+        UnevenStartWorker.instances = 0
+        self.start_service(
+            UnevenStartWorker,
+            number_of_workers=2,
+            heartbeat_interval=20
+        )
+        client = RemoteClient(default_timeout=1000)
+        client.connect(self.endpoint)
+        for _ in range(4):
+            response = client.resolve({'$req': 'HELLO'})
+            self.assertEqual(response['$error'], 'No handler match')
+        client.close()
+        self.assertEqual(self.eval_attr('total_dead_workers'), 0)
+
+    def test_startup_timeout(self):
+        UnevenStartWorker.instances = 0
+        with self.assertRaises(WorkerStartupTimeout):
+            self.start_service(
+                UnevenStartWorker,
+                number_of_workers=2,
+                startup_timeout=50
+            )
+        self.assertFalse(self.service.is_started())
+        # Nothing is left bound: the next start succeeds.
+        self.service.start()
+        self.assertEqual(self.eval_attr('number_of_workers'), 2)
+
+    def test_coalesce_identical_requests(self):
+        self.start_service(
+            CountWorker,
+            number_of_workers=4,
+            coalesce_patterns=[{'$req': 'slow-count'}]
+        )
+        CountWorker.calls = 0
+        responses = self.resolve_all(
+            [{'$req': 'slow-count', 'delay': 0.2}] * 10 +
+            [{'$req': 'count'}] * 2
+        )
+        self.assertEqual(responses[:10], [{'$rep': 1}] * 10)
+        # Requests not matching a pattern are never coalesced.
+        self.assertEqual(CountWorker.calls, 3)
+        self.assertEqual(self.eval_attr('total_coalesced_requests'), 9)
+
+    def test_coalesced_requests_counted_once(self):
+        self.start_service(
+            CountWorker,
+            max_pending_requests=10,
+            coalesce_patterns=[{'$req': 'slow-count'}]
+        )
+        message = {'$req': 'slow-count'}
+
+        async def resolve_all():
+            # The leader expires while the only worker is busy; a waiter
+            # takes over and the others attach to it.
+            return await asyncio.gather(
+                self.client.resolve({'$req': 'count', 'delay': 0.3}),
+                self.client.resolve(message, timeout=100),
+                *[self.client.resolve(message) for _ in range(3)],
+                return_exceptions=True
+            )
+
+        responses = self.loop.run_until_complete(resolve_all())
+        self.assertIsInstance(responses[1], IOTimeout)
+        self.assertEqual(len({r['$rep'] for r in responses[2:]}), 1)
+        self.assertEqual(self.eval_attr('total_coalesced_requests'), 3)
+
+
 class TestServiceController(unittest.TestCase):
 
     def test_service_controller_start_thread(self):
@@ -107,3 +747,7 @@ class TestServiceController(unittest.TestCase):
             controller.resolve,
             {'$req': 'hello'}
         )
+
+    def test_invalid_prefetch(self):
+        for prefetch in (0, -1, 1.5, None):
+            self.assertRaises(ValueError, Service, prefetch=prefetch)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+import zmq
+
+from lucena.io2.codec import binary_codec
+from lucena.io2.socket import Socket, deadline_expired
+
+
+class TestSocket(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSocket, self).setUp()
+        self.socket_0, self.socket_1 = Socket.socket_pair(
+            zmq.Context.instance()
+        )
+        self.message = {'$req': 'hello', 'body': 'x' * 100}
+
+    def tearDown(self):
+        self.socket_0.close()
+        self.socket_1.close()
+        super(TestSocket, self).tearDown()
+
+    def test_recv_from_client_decodes_payload(self):
+        self.socket_0.send_to_client(b'client', b'uuid', self.message)
+        response = self.socket_1.recv_from_client()
+        self.assertEqual(response.message, self.message)
+        self.assertEqual(response.client, b'client')
+        self.assertEqual(response.uuid, b'uuid')
+
+    def test_payload_passthrough(self):
+        self.socket_0.send_to_client(b'client', b'uuid', self.message)
+        response = self.socket_1.recv_from_client(decode=False)
+        self.assertIsInstance(response.message, zmq.Frame)
+        self.assertEqual(response.client, b'client')
+        self.socket_1.send_to_worker(
+            b'worker',
+            response.client,
+            response.uuid,
+            response.message
+        )
+        response = self.socket_0.recv_from_worker()
+        self.assertEqual(response.message, self.message)
+        self.assertEqual(response.worker, b'worker')
+
+    def test_passthrough_keeps_binary_payloads(self):
+        self.socket_0.codec = binary_codec
+        self.socket_0.send_to_service(b'uuid', self.message)
+        response = self.socket_1.recv_from_service(decode=False)
+        self.assertTrue(
+            response.message.bytes.startswith(binary_codec.MAGIC)
+        )
+        self.socket_1.send_to_service(response.uuid, response.message)
+        self.assertEqual(
+            self.socket_0.recv_from_service().message,
+            self.message
+        )
+
+    def test_headers_roundtrip(self):
+        headers = {'deadline': time.time() + 10}
+        for decode in (True, False):
+            self.socket_0.send_to_worker(
+                b'worker', b'client', b'uuid', self.message, headers
+            )
+            response = self.socket_1.recv_from_worker(decode=decode)
+            self.assertEqual(response.headers, headers)
+            self.assertEqual(response.uuid, b'uuid')
+            message = response.message if decode \
+                else Socket.decode(response.message)
+            self.assertEqual(message, self.message)
+            self.assertFalse(response.expired)
+
+    def test_deadline_expired(self):
+        self.assertFalse(deadline_expired(None))
+        self.assertFalse(deadline_expired({'deadline': None}))
+        self.assertTrue(deadline_expired({'deadline': 10}, now=11))
+        self.assertFalse(deadline_expired({'deadline': 10}, now=9))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import json
+import tempfile
+import unittest
+
+from lucena.io2.socket import trace_event
+from lucena.tracing import JSONLSink, MemorySink, Tracer
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_sample_rate(self):
+        self.assertIsNone(Tracer(MemorySink(), sample_rate=0).start())
+        self.assertIn('client_send', Tracer(MemorySink()).start())
+        self.assertRaises(ValueError, Tracer, MemorySink(), sample_rate=2)
+
+    def test_finish_records_durations(self):
+        sink = MemorySink(capacity=1)
+        tracer = Tracer(sink)
+        trace = tracer.start()
+        headers = {'trace': trace}
+        trace_event(headers, 'broker_receive', trace['client_send'] + 0.001)
+        trace_event(None, 'dispatch')
+        tracer.finish(trace)
+        tracer.finish(tracer.start())
+        self.assertEqual(len(sink.traces), 1)
+        self.assertIsNot(sink.traces[0], trace)
+        self.assertAlmostEqual(
+            trace['durations']['client_send-broker_receive'],
+            1,
+            places=3
+        )
+        self.assertIn('broker_receive-client_receive', trace['durations'])
+
+    def test_jsonl_sink(self):
+        path = tempfile.NamedTemporaryFile().name
+        sink = JSONLSink(path)
+        tracer = Tracer(sink)
+        for _ in range(2):
+            tracer.finish(tracer.start())
+        sink.close()
+        with open(path) as f:
+            traces = [json.loads(line) for line in f]
+        self.assertEqual(len(traces), 2)
+        self.assertIn('client_receive', traces[0])
@@ -1,14 +1,32 @@
 # -*- coding: utf-8 -*-
 import threading
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 
 from lucena.exceptions import WorkerAlreadyStarted, WorkerNotStarted, \
-    LookupHandlerError
+    WorkerStartupTimeout, LookupHandlerError
 from lucena.worker import Worker
 from lucena.io2.socket import Response
 
 
+class SlowStartWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(SlowStartWorker, self).__init__(*args, **kwargs)
+        time.sleep(0.3)
+
+
+class SleepWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super(SleepWorker, self).__init__(*args, **kwargs)
+        self.bind_handler({'$req': 'sleep'}, SleepWorker.handler_sleep)
+
+    @staticmethod
+    def handler_sleep(message):
+        time.sleep(message['seconds'])
+        return {'$rep': 'slept'}
+
+
 class TestWorker(unittest.TestCase):
 
     def setUp(self):
@@ -34,6 +52,61 @@ class TestWorker(unittest.TestCase):
             self.message
         )
 
+    def test_lookup_handler_after_unbind(self):
+        def other_handler():
+            return None
+
+        self.worker.bind_handler({'a': 123}, other_handler)
+        self.worker.bind_handler(self.message, self.basic_handler)
+        self.assertEqual(
+            self.worker.get_handler_for(self.message),
+            self.basic_handler
+        )
+        self.worker.unbind_handler(self.message)
+        self.assertEqual(
+            self.worker.get_handler_for(self.message),
+            other_handler
+        )
+
+    def test_batch_handler(self):
+        batches = []
+
+        def handler_double(messages):
+            batches.append(len(messages))
+            return [{'$rep': message['n'] * 2} for message in messages]
+
+        self.worker.bind_batch_handler({'$req': 'double'}, handler_double)
+        self.worker.bind_handler({'$req': 'double', 'n': 0}, lambda m: 0)
+        self.assertEqual(self.worker.batch_patterns, [{'$req': 'double'}])
+        self.assertEqual(
+            self.worker.resolve({'$req': 'double', 'n': 2}),
+            {'$rep': 4}
+        )
+        messages = [{'$req': 'double', 'n': n} for n in (1, 2, 3)]
+        self.assertEqual(
+            self.worker.resolve_batch(messages),
+            [{'$rep': 2}, {'$rep': 4}, {'$rep': 6}]
+        )
+        self.assertEqual(batches, [1, 3])
+        # A more specific handler wins: fall back to one by one.
+        self.assertEqual(
+            self.worker.resolve_batch(messages + [{'$req': 'double', 'n': 0}]),
+            [{'$rep': 2}, {'$rep': 4}, {'$rep': 6}, 0]
+        )
+        self.assertEqual(batches, [1, 3, 1, 1, 1])
+
+    def test_resolve_records_metrics(self):
+        self.worker.bind_handler({'$req': 'echo'}, lambda message: message)
+        self.worker.resolve({'$req': 'echo'})
+        self.worker.resolve({'$req': 'unknown'})
+        handlers = self.worker.get_metrics()['handlers']
+        self.assertEqual(handlers['{"$req": "echo"}']['requests'], 1)
+        self.assertEqual(handlers['{"$req": "echo"}']['errors'], 0)
+        # The default handler replies with an error.
+        self.assertEqual(handlers['{}']['errors'], 1)
+        response = self.worker.resolve({'$req': 'metrics'})
+        self.assertIn('busy_time', response['$rep'])
+
     def test_unbind_unknown_handler_raises_an_exception(self):
         self.worker.bind_handler(self.message, self.basic_handler)
         self.worker.unbind_handler(self.message)
@@ -44,6 +117,36 @@ class TestWorker(unittest.TestCase):
         )
 
 
+class TestWorkerTimers(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWorkerTimers, self).setUp()
+        self.worker = Worker()
+        self.worker._before_start()
+        self.calls = []
+
+    def tearDown(self):
+        self.worker._before_stop()
+        super(TestWorkerTimers, self).tearDown()
+
+    def test_poll_blocks_until_timer_fires(self):
+        self.worker._add_timer(0.05, lambda: self.calls.append('once'))
+        start = time.monotonic()
+        while not self.calls:
+            self.worker._handle_poll()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertEqual(self.worker._next_timeout(), None)
+
+    def test_periodic_timer_and_cancel(self):
+        timer = self.worker._add_timer(
+            0, lambda: self.calls.append('tick'), interval=0.01
+        )
+        while len(self.calls) < 3:
+            self.worker._handle_poll()
+        self.worker._cancel_timer(timer)
+        self.assertEqual(self.worker._next_timeout(), None)
+
+
 class TestWorkerController(unittest.TestCase):
 
     def test_worker_controller_start_thread(self):
@@ -59,6 +162,110 @@ class TestWorkerController(unittest.TestCase):
                 controller.start()
                 m_thread.assert_called_once()
 
+    def test_worker_skips_expired_requests(self):
+        controller = Worker.Controller()
+        worker_id = controller.start()[0]
+        headers = {'deadline': time.time() - 1}
+        controller.send(
+            worker_id, b'client', b'$uuid', {'$req': 'eval'}, headers
+        )
+        response = controller.recv()
+        self.assertEqual(response.message['$error'], 'Deadline exceeded')
+        self.assertEqual(response.headers, headers)
+        controller.stop()
+
+    def test_workers_start_concurrently(self):
+        controller = Worker.Controller(worker_factory=SlowStartWorker)
+        start = time.monotonic()
+        worker_ids = controller.start(number_of_workers=8)
+        self.assertLess(time.monotonic() - start, 8 * 0.3 / 2)
+        self.assertEqual(len(set(worker_ids)), 8)
+        controller.stop()
+
+    def test_start_timeout(self):
+        threads = threading.active_count()
+        controller = Worker.Controller(worker_factory=SlowStartWorker)
+        with self.assertRaises(WorkerStartupTimeout):
+            controller.start(number_of_workers=2, timeout=50)
+        self.assertFalse(controller.is_started())
+        # The cancelled threads return once built, without connecting.
+        deadline = time.monotonic() + 2
+        while threading.active_count() > threads and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), threads)
+        controller.start(number_of_workers=2)
+        self.assertEqual(controller.stop(), [])
+
+    def test_stop_drains_in_flight_requests(self):
+        controller = Worker.Controller(worker_factory=SleepWorker)
+        worker_ids = controller.start(number_of_workers=4)
+        controller.send(
+            worker_ids[0],
+            b'client',
+            b'$uuid',
+            {'$req': 'sleep', 'seconds': 0.2}
+        )
+        responses = []
+        late_workers = controller.stop(handle_response=responses.append)
+        self.assertEqual(late_workers, [])
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0].worker, worker_ids[0])
+
+    def test_worker_stops_without_controller_heartbeats(self):
+        controller = Worker.Controller(
+            worker_factory=Worker,
+            heartbeat_interval=20
+        )
+        worker_ids = controller.start()
+        running_worker = list(controller.running_workers.values())[0]
+        # The liveness clock starts with the first controller message.
+        controller.send(worker_ids[0], b'client', b'$uuid', {'$req': 'x'})
+        while controller.recv().client != b'client':
+            pass
+        with self.assertLogs('lucena.worker', level='WARNING'):
+            running_worker.runner.join(timeout=1)
+        self.assertFalse(running_worker.runner.is_alive())
+        # Not waited for, even without a deadline.
+        self.assertEqual(controller.stop(), [])
+
+    def test_stop_reports_late_workers(self):
+        controller = Worker.Controller(worker_factory=SleepWorker)
+        worker_ids = controller.start(number_of_workers=2)
+        controller.send(
+            worker_ids[1],
+            b'client',
+            b'$uuid',
+            {'$req': 'sleep', 'seconds': 0.3}
+        )
+        running_workers = list(controller.running_workers.values())
+        start = time.monotonic()
+        with self.assertLogs('lucena.worker', level='WARNING'):
+            late_workers = controller.stop(timeout=50)
+        self.assertLess(time.monotonic() - start, 0.25)
+        self.assertEqual(late_workers, [worker_ids[1]])
+        self.assertTrue(running_workers[1].runner.is_alive())
+        # The late worker replies and then handles the queued stop.
+        controller.control_socket.recv_from_worker()
+        running_workers[1].runner.join()
+
+    def test_stop_reports_discarded_workers_still_running(self):
+        controller = Worker.Controller(worker_factory=SleepWorker)
+        worker_ids = controller.start(number_of_workers=2)
+        controller.send(
+            worker_ids[1],
+            b'client',
+            b'$uuid',
+            {'$req': 'sleep', 'seconds': 0.3}
+        )
+        running_worker = controller.running_workers[worker_ids[1]]
+        controller.discard_worker(worker_ids[1])
+        self.assertEqual(controller.abandoned_workers(), [worker_ids[1]])
+        with self.assertLogs('lucena.worker', level='WARNING'):
+            late_workers = controller.stop()
+        self.assertEqual(late_workers, [worker_ids[1]])
+        running_worker.runner.join()
+
     def test_start_worker_fails_if_already_started(self):
         controller = Worker.Controller()
         controller.start()
@@ -100,3 +307,25 @@ class TestWorkerController(unittest.TestCase):
             controller.start,
             number_of_workers=-10
         )
+
+
+class TestProcessWorkerController(unittest.TestCase):
+
+    def test_process_workers(self):
+        controller = Worker.Controller(worker_mode='process')
+        self.assertTrue(
+            controller.control_socket.last_endpoint.startswith(b'ipc://')
+        )
+        worker_ids = controller.start(number_of_workers=2)
+        for worker_id in worker_ids:
+            controller.send(worker_id, b'client', b'$uuid', {'$req': 'hi'})
+            response = controller.recv()
+            self.assertEqual(response.worker, worker_id)
+            self.assertEqual(response.message['$error'], 'No handler match')
+        running_workers = list(controller.running_workers.values())
+        controller.stop()
+        for running_worker in running_workers:
+            self.assertFalse(running_worker.runner.is_alive())
+
+    def test_invalid_worker_mode(self):
+        self.assertRaises(ValueError, Worker.Controller, worker_mode='fiber')